@@ -33,6 +33,10 @@ CACHEDIR = Path(os.environ.get(
 )).resolve(strict=False)
 
 ROOTFS_CACHE = CACHEDIR / "rootfs"
+APK_STORE = CACHEDIR / "apk-store"
+DISTFILE_STORE = CACHEDIR / "distfiles"
+TRASHDIR = LOCALSTATEDIR / "trash"
+POOLDIR = LOCALSTATEDIR / "pool"
 
 MOUNTS = {
     "aportsdir": "/af/aports",
@@ -79,6 +83,16 @@ _DEFAULT_SITE_CONFIG = {
     "container": {
         "subuid": "100000",
         "subgid": "100000",
+        "pool-size": "0",
+        "cgroup": "",
+        "cpus": "",
+        "cpuset": "",
+        "memory-max": "",
+        "io-weight": "",
+    },
+    "metrics": {
+        "textfile": "",
+        "expire": "86400",
     },
     "setarch": {
     },
@@ -93,10 +107,18 @@ _DEFAULT_PROJ_CONFIG = {
         "repo.default": "", # str
         # Optional
         "rootfs.exclude": "", # list
+        "build.abi-rebuild": "false", # bool
+        "build.defer-index": "false", # bool
+        "build.deps-lookahead": "false", # bool
+        "build.log-compress": "false", # bool
+        "build.log-tail": "100", # int
         "build.networking": "false",
         "build.on-failure": "stop", # str
         "build.only-changed-versions": "false", # bool
+        "build.order": "default", # str
         "build.skip": "", # maplist
+        "build.tmpfs-size": "", # str
+        "build.tmpfs-skip": "", # list
         "container.persistent-repodest": "false", # bool
         "deps.ignore": "", # maplist
         "deps.map": "", # map
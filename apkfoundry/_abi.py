@@ -0,0 +1,131 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import collections # defaultdict
+import logging     # getLogger
+import re          # compile
+import tarfile     # open, ReadError
+
+_LOGGER = logging.getLogger(__name__)
+
+# Only these provides describe an ABI that other packages link against.
+# Their versions are ignored: so: versions track the package version,
+# and a soname change already shows up as a different name.
+_ABI_PREFIXES = ("so:", "pc:")
+_VERSION_OP = re.compile(r"[<>=~]")
+
+def _abi_names(names):
+    # Format: NAME[OPERATOR VERSION], e.g. so:libc.so=1 or pc:zlib>=1.2
+    return {
+        _VERSION_OP.split(i, maxsplit=1)[0] for i in names
+        if i.startswith(_ABI_PREFIXES)
+    }
+
+def index_packages(index):
+    """Return a mapping of origin (the pkgname of the APKBUILD) to the
+    packages built from it according to the APKINDEX.tar.gz at index,
+    described as a dictionary with the following keys:
+
+    * version: the version of the packages
+    * provides: the set of so: and pc: names that they provide
+    * depends: the set of so: and pc: names that they depend on"""
+    packages = collections.defaultdict(
+        lambda: {"version": None, "provides": set(), "depends": set()}
+    )
+    try:
+        with tarfile.open(index, "r:gz") as tar:
+            text = tar.extractfile("APKINDEX").read().decode("utf-8")
+    except (OSError, KeyError, tarfile.ReadError) as e:
+        _LOGGER.debug("%s: %s", index, e)
+        return packages
+
+    # Format: one "X:VALUE" line per field, blank line between packages
+    for record in text.split("\n\n"):
+        fields = dict(
+            line.split(":", maxsplit=1) for line in record.splitlines()
+            if ":" in line
+        )
+        origin = fields.get("o", fields.get("P"))
+        if origin:
+            package = packages[origin]
+            package["version"] = fields.get("V")
+            package["provides"] |= _abi_names(fields.get("p", "").split())
+            package["depends"] |= _abi_names(fields.get("D", "").split())
+
+    return packages
+
+def _pkginfo(apk):
+    with tarfile.open(apk, "r:gz") as tar:
+        for member in tar:
+            if member.name == ".PKGINFO":
+                return tar.extractfile(member).read().decode("utf-8")
+    raise tarfile.ReadError(".PKGINFO not found")
+
+def apk_provides(apks):
+    """Return the origin and the set of so: and pc: names provided by
+    the given .apk files (all built from the same APKBUILD), or
+    (None, None) if any of them could not be read."""
+    origin = None
+    provides = []
+    for apk in apks:
+        try:
+            text = _pkginfo(apk)
+        except (OSError, tarfile.ReadError) as e:
+            _LOGGER.warning("%s: %s", apk.name, e)
+            return None, None
+
+        # Format: "key = value" per line
+        for line in text.splitlines():
+            key, _, value = line.partition(" = ")
+            if key == "origin":
+                origin = value
+            elif key == "provides":
+                provides.append(value)
+
+    return origin, _abi_names(provides)
+
+def old_index(repodest, cache, indexdir):
+    """Return the packages in the index of the REPO/ARCH directory
+    indexdir in repodest (see index_packages), reading it only the first
+    time it is requested for the given cache."""
+    if indexdir not in cache:
+        cache[indexdir] = index_packages(
+            repodest / indexdir / "APKINDEX.tar.gz"
+        )
+    return cache[indexdir]
+
+def rebuilds(repodest, graph, startdir, manifest, cache, arch):
+    """Return the reverse dependencies of startdir that need to be
+    rebuilt because its new packages (as given in its manifest) no
+    longer provide some of the so: or pc: names that the previous
+    version did and that their own packages depend on, mapped to the
+    version of those packages. Indexes are read using old_index with
+    the given cache."""
+    if manifest is None:
+        _LOGGER.warning("%s: no manifest; skipping ABI check", startdir)
+        return {}
+
+    origin, new = apk_provides(
+        [repodest / i["path"] for i in manifest["packages"]]
+    )
+    if origin is None:
+        return {}
+    old = old_index(repodest, cache, f"{startdir.split('/')[0]}/{arch}")
+    if origin not in old:
+        return {}
+
+    broken = old[origin]["provides"] - new
+    if not broken:
+        return {}
+
+    _LOGGER.warning(
+        "%s: no longer provides %s", startdir, " ".join(sorted(broken)),
+    )
+    rdeps = {}
+    for rdep in graph.graph.get(startdir, ()):
+        name = graph.metadata.get(rdep, {}).get("pkgname")
+        index = old_index(repodest, cache, f"{rdep.split('/')[0]}/{arch}")
+        if name in index and index[name]["depends"] & broken:
+            rdeps[rdep] = index[name]["version"]
+
+    return rdeps
@@ -0,0 +1,175 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2019-2020 Max Rees
+# See LICENSE for more information.
+import logging # getLogger
+import re      # compile
+import shutil  # rmtree
+from pathlib import Path
+
+import apkfoundry # MOUNTS
+import apkfoundry._manifest as _manifest
+
+_LOGGER = logging.getLogger(__name__)
+
+_DEPS_VIRTUAL = ".af-builddeps"
+MANIFEST = "/var/tmp/af-manifest"
+_NET_OPTION = re.compile(r"""^options=(["']?)[^"']*\bnet\b[^"']*\1""")
+
+def run_env(cont, startdir, tmpfs=False):
+    buildbase = Path(apkfoundry.MOUNTS["builddir"]) / startdir
+
+    tmp_real = cont.cdir / "af/config/builddir" / startdir / "tmp"
+    try:
+        shutil.rmtree(tmp_real.parent)
+    except (FileNotFoundError, PermissionError):
+        pass
+    if tmpfs:
+        # The builddir is empty when the container starts
+        tmp = "/tmp"
+    else:
+        tmp_real.mkdir(parents=True, exist_ok=True)
+        tmp = str(buildbase / "tmp")
+
+    env = {
+        "HOME": tmp,
+        "TEMP": tmp,
+        "TEMPDIR": tmp,
+        "TMP": tmp,
+        "TMPDIR": tmp,
+
+        "ABUILD_TMP": str(apkfoundry.MOUNTS["builddir"]),
+        # "deps" is a waste of time since world will be refreshed
+        # on next package
+        "CLEANUP": "srcdir pkgdir",
+        "ERROR_CLEANUP": "",
+    }
+
+    return env, tmp_real
+
+def _source_path(cont, startdir, source):
+    # Where abuild looks for the source
+    if "::" in source:
+        name, _, url = source.partition("::")
+    else:
+        name, url = source.rsplit("/", maxsplit=1)[-1], source
+
+    if "://" in url:
+        return cont.cdir / "af/config/srcdest" / name
+    return cont.cdir / "af/config/aportsdir" / startdir / name
+
+def _up2date(cont, startdir, meta, arch):
+    """Equivalent to abuild up2date, using the metadata from af-deps
+    instead of sourcing the APKBUILD."""
+    repodest = cont.cdir / "af/config/repodest" / startdir.split("/")[0] / arch
+    version = f"{meta['pkgver']}-r{meta['pkgrel']}"
+    names = [i.split(":")[0] for i in meta.get("subpackages", ())]
+
+    try:
+        built = (repodest / f"{meta['pkgname']}-{version}.apk").stat().st_mtime
+    except FileNotFoundError:
+        return False
+    for name in names:
+        if not (repodest / f"{name}-{version}.apk").is_file():
+            return False
+
+    for source in (*meta.get("source", ()), "APKBUILD"):
+        try:
+            if _source_path(cont, startdir, source).stat().st_mtime > built:
+                return False
+        except FileNotFoundError:
+            continue
+
+    return True
+
+def _build_deps(graph, startdir, pending):
+    # Dependencies provided by packages that have yet to be built in
+    # this job must come from REPODEST later, so leave them to abuild
+    return {
+        name for name in graph.depnames.get(startdir, ())
+        if graph.origins.get(name) not in pending
+    }
+
+def install_deps(cont, graph, order, cur):
+    """Install the build dependencies of order[cur] together with those
+    of the following package in a single apk transaction. The refresh
+    script has just reset the world file, so packages needed by neither
+    build are removed and packages needed by both are left alone."""
+    startdir = order[cur]
+    repo = startdir.split("/")[0]
+    pending = set(order[cur:])
+    names = _build_deps(graph, startdir, pending)
+    # The next package may use different repositories otherwise
+    if cur + 1 < len(order) and order[cur + 1].startswith(repo + "/"):
+        names |= _build_deps(graph, order[cur + 1], pending)
+    if not names:
+        return False
+
+    _LOGGER.info("Installing %d build dependencies", len(names))
+    rc, _ = cont.run(
+        [
+            "apk", "add",
+            "--repository", str(Path(apkfoundry.MOUNTS["repodest"]) / repo),
+            "--virtual", _DEPS_VIRTUAL,
+            *sorted(names),
+        ],
+        repo=repo,
+        su=True, net=True, ro_root=False,
+    )
+    if rc != 0:
+        _LOGGER.warning("%s: failed to install build dependencies", startdir)
+        return False
+
+    return True
+
+def read_manifest(cont):
+    # Written by af_abuild
+    try:
+        paths = (cont.cdir / MANIFEST.lstrip("/")).read_text().split()
+    except FileNotFoundError:
+        return None
+
+    return _manifest.build_manifest(cont.cdir / "af/config/repodest", paths)
+
+def task_env(cont, conf, startdir, meta, jobs, force):
+    # Returns the environment of the build, its temporary directory,
+    # and the size of its tmpfs (if any)
+    tmpfs_size = conf["build.tmpfs-size"].strip()
+    if tmpfs_size and startdir in conf.getlist("build.tmpfs-skip"):
+        _LOGGER.info("%s: building on disk instead of tmpfs", startdir)
+        tmpfs_size = None
+
+    env, tmp = run_env(cont, startdir, tmpfs=bool(tmpfs_size))
+    if jobs:
+        env["JOBS"] = str(jobs)
+        env["MAKEFLAGS"] = f"-j{jobs}"
+    env["AF_MANIFEST"] = MANIFEST
+    if conf.getboolean("build.defer-index"):
+        env["AF_DEFER_INDEX"] = "1"
+
+    if meta:
+        # Used by af_loginit and af_abuild
+        env["AF_PKGNAME"] = meta["pkgname"]
+        env["AF_PKGVER"] = meta["pkgver"]
+        env["AF_PKGREL"] = meta["pkgrel"]
+        if not meta.get("masked"):
+            up2date = _up2date(cont, startdir, meta, cont.arch)
+            env["AF_UP2DATE"] = "1" if up2date else "0"
+    if force:
+        # Rebuild even though nothing changed
+        env["AF_UP2DATE"] = "0"
+        env["AF_FORCE"] = "1"
+
+    return env, tmp, tmpfs_size
+
+def task_net(cont, conf, startdir, meta):
+    if conf.getboolean("build.networking"):
+        return True
+    if meta:
+        return "net" in meta.get("options", ())
+
+    APKBUILD = cont.cdir / f"af/config/aportsdir/{startdir}/APKBUILD"
+    with open(APKBUILD) as f:
+        for line in f:
+            if _NET_OPTION.search(line) is not None:
+                return True
+    return False
@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2019-2020 Max Rees
+# See LICENSE for more information.
+import enum     # IntFlag, unique
+import json     # dump
+import logging  # getLogger
+import sys      # stdout
+import textwrap # TextWrapper
+
+import apkfoundry._log as _log
+import apkfoundry._logsink as _logsink
+import apkfoundry._manifest as _manifest
+import apkfoundry._metrics as _metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+@enum.unique
+class Status(enum.IntFlag):
+    DONE = 8
+    ERROR = DONE | 16      # 24
+    CANCEL = ERROR | 32    # 56
+    SUCCESS = DONE | 64    # 72
+    FAIL = ERROR | 128     # 152
+    DEPFAIL = CANCEL | 256 # 312
+
+    # The following (and also CANCEL) are no longer used and may be
+    # removed in a future version.
+    NEW = 1
+    REJECT = 2
+    START = 4
+    SKIP = DONE | 512      # 520
+
+    def __str__(self):
+        return self.name
+
+_REPORT_STATUSES = (
+    Status.SUCCESS,
+    Status.DEPFAIL,
+    Status.FAIL,
+    Status.ERROR,
+    Status.CANCEL,
+)
+_STATS_FILE = "af/af-stats.json"
+_wrap = textwrap.TextWrapper()
+
+def _stats_list(status, l):
+    if not l:
+        return
+
+    _LOGGER.info("%s: %d", status.name.title(), len(l))
+    l = _wrap.fill(" ".join(l)).splitlines()
+    for i in l:
+        _log.msg2(_LOGGER, "%s", i)
+
+def _stats_usage(usage):
+    if not usage:
+        return
+
+    _LOGGER.info("Resource usage:")
+    for startdir, stats in sorted(
+            usage.items(), key=lambda i: i[1].get("cpu_usec", 0),
+            reverse=True):
+        _log.msg2(
+            _LOGGER,
+            "%s: %.1fs CPU, %d MiB peak memory, %d MiB read, %d MiB written",
+            startdir,
+            stats.get("cpu_usec", 0) / 1e6,
+            stats.get("memory_peak", 0) >> 20,
+            stats.get("io_rbytes", 0) >> 20,
+            stats.get("io_wbytes", 0) >> 20,
+        )
+
+def write_stats(cont, done, results):
+    usage = {
+        startdir: result.usage for startdir, result in results.items()
+        if result.usage
+    }
+    produced = {
+        startdir: result.manifest for startdir, result in results.items()
+        if result.manifest is not None
+    }
+
+    # Not in REPODEST, which is published
+    try:
+        with open(cont.cdir / _STATS_FILE, "w") as f:
+            json.dump({
+                startdir: {"status": str(status), **usage.get(startdir, {})}
+                for startdir, status in done.items()
+            }, f, indent=2)
+    except OSError as e:
+        _LOGGER.warning("Could not write %s: %s", _STATS_FILE, e)
+
+    # Builds that didn't go through af_abuild have no manifest
+    complete = all(
+        startdir in produced
+        for startdir, status in done.items() if status == Status.SUCCESS
+    )
+    _manifest.write(cont.cdir, produced, complete)
+
+def write_metrics(done):
+    for status in _REPORT_STATUSES:
+        _metrics.gauge(
+            "builds", sum(1 for i in done.values() if i == status),
+            status=str(status),
+        )
+    _metrics.write()
+
+def _stats_logs(done, logs):
+    failed = [i for i in logs if done.get(i) != Status.SUCCESS]
+    if not failed:
+        return
+
+    _LOGGER.info("Logs of failed builds:")
+    for startdir in failed:
+        _log.msg2(_LOGGER, "%s: %s", startdir, logs[startdir])
+
+def stats_builds(done, results=None):
+    _LOGGER.info("Total: %d", len(done))
+
+    statuses = {
+        status: [i for i in done if done[i] == status]
+        for status in _REPORT_STATUSES
+    }
+
+    for status, startdirs in statuses.items():
+        _stats_list(status, startdirs)
+
+    results = results or {}
+    _stats_usage({
+        startdir: result.usage for startdir, result in results.items()
+        if result.usage
+    })
+    _stats_logs(done, {
+        startdir: result.log for startdir, result in results.items()
+        if result.log
+    })
+
+    for status in set(_REPORT_STATUSES) - {Status.SUCCESS}:
+        if any(statuses[status]):
+            return 1
+    return 0
+
+def log_sink(cont, conf, startdir, meta):
+    if not meta or not conf.getboolean("build.log-compress"):
+        return None
+
+    log = "/".join((
+        startdir.split("/")[0], cont.arch, "logs",
+        f"{meta['pkgname']}-{meta['pkgver']}-r{meta['pkgrel']}.log.gz",
+    ))
+    return _logsink.LogSink(
+        cont.cdir / "af/config/repodest" / log,
+        sys.stdout.buffer,
+        tail=conf.getint("build.log-tail"),
+    ), log
@@ -0,0 +1,273 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import logging # getLogger
+import math    # isfinite
+import os      # getpid
+import re      # compile
+from pathlib import Path
+
+import apkfoundry # site_conf
+
+_LOGGER = logging.getLogger(__name__)
+
+CGROUP_FS = Path("/sys/fs/cgroup")
+_CONTROLLERS = ("cpu", "cpuset", "memory", "io")
+_CPU_PERIOD = 100000
+# Leaf for the processes that were started in the delegated cgroup
+# itself, such as af-buildrepo
+_SUPERVISOR = "supervisor"
+_MEMORY_MAX = re.compile(r"^(max|[0-9]+[KMGT]?)$")
+
+def _base():
+    base = apkfoundry.site_conf("container").get("cgroup", "").strip()
+    if not base:
+        return None
+    return CGROUP_FS / base.lstrip("/")
+
+def _move_to_leaf(base):
+    # Controllers can only be enabled for the children of a cgroup that
+    # has no processes of its own (the "no internal processes" rule)
+    procs = (base / "cgroup.procs").read_text().split()
+    if not procs:
+        return
+
+    leaf = base / _SUPERVISOR
+    leaf.mkdir(exist_ok=True)
+    for pid in procs:
+        try:
+            (leaf / "cgroup.procs").write_text(pid)
+        except ProcessLookupError:
+            # Already exited
+            continue
+
+def _enable_controllers(base):
+    available = (base / "cgroup.controllers").read_text().split()
+    enabled = (base / "cgroup.subtree_control").read_text().split()
+    wanted = [i for i in _CONTROLLERS if i in available and i not in enabled]
+    if not wanted:
+        return
+
+    try:
+        _move_to_leaf(base)
+        (base / "cgroup.subtree_control").write_text(
+            " ".join("+" + i for i in wanted)
+        )
+    except OSError as e:
+        _LOGGER.warning("Could not enable cgroup controllers: %s", e)
+
+def _enabled_controllers(base):
+    _enable_controllers(base)
+    return (base / "cgroup.subtree_control").read_text().split()
+
+def _read_flat(path):
+    # Format: KEY VALUE\n...
+    stats = {}
+    for line in path.read_text().splitlines():
+        key, value = line.split()
+        stats[key] = int(value)
+    return stats
+
+def _read_io(path):
+    # Format: MAJ:MIN KEY=VALUE KEY=VALUE ...\n...
+    stats = {}
+    for line in path.read_text().splitlines():
+        for field in line.split()[1:]:
+            key, value = field.split("=", maxsplit=1)
+            stats[key] = stats.get(key, 0) + int(value)
+    return stats
+
+def cpuset_size(cpuset):
+    # Format: 0-3,8,10-11
+    size = 0
+    for i in cpuset.split(","):
+        first, sep, last = i.strip().partition("-")
+        try:
+            first = int(first)
+            last = int(last) if sep else first
+        except ValueError:
+            first, last = 0, -1
+        if not 0 <= first <= last:
+            raise ValueError(f"invalid cpuset: {cpuset!r}")
+        size += last - first + 1
+    return size
+
+# The following check the values of the resource limits and return them
+# normalized, or raise ValueError
+
+def check_cpus(value):
+    try:
+        cpus = float(value)
+    except ValueError:
+        cpus = 0
+    if not (cpus > 0 and math.isfinite(cpus)):
+        raise ValueError(f"invalid number of CPUs: {value!r}")
+    return str(value).strip()
+
+def check_cpuset(value):
+    cpuset_size(value)
+    return value.strip()
+
+def check_memory_max(value):
+    if not _MEMORY_MAX.match(value.strip()):
+        raise ValueError(f"invalid memory size: {value!r}")
+    return value.strip()
+
+def check_io_weight(value):
+    try:
+        weight = int(value)
+    except ValueError:
+        weight = 0
+    if not 1 <= weight <= 10000:
+        raise ValueError(f"invalid I/O weight: {value!r}")
+    return str(weight)
+
+def limit_files(*, cpus=None, cpuset=None, memory_max=None, io_weight=None):
+    files = {}
+    if cpus:
+        files["cpu.max"] = f"{int(float(cpus) * _CPU_PERIOD)} {_CPU_PERIOD}"
+    if cpuset:
+        files["cpuset.cpus"] = cpuset
+    if memory_max:
+        files["memory.max"] = memory_max
+    if io_weight:
+        files["io.weight"] = f"default {io_weight}"
+    return files
+
+LIMIT_CHECKS = {
+    "cpus": check_cpus,
+    "cpuset": check_cpuset,
+    "memory_max": check_memory_max,
+    "io_weight": check_io_weight,
+}
+
+def check_limits(opts):
+    """Fill in the resource limits in opts that were not given on the
+    command line from the site configuration. Returns False if any of
+    them is invalid or if limits are set without a delegated cgroup."""
+    # Options given on the command line have been checked by argparse
+    site = apkfoundry.site_conf("container")
+    for opt, check in LIMIT_CHECKS.items():
+        if getattr(opts, opt, None) is not None:
+            continue
+        value = site[opt.replace("_", "-")].strip()
+        try:
+            setattr(opts, opt, check(value) if value else "")
+        except ValueError as e:
+            _LOGGER.error("container.%s: %s", opt.replace("_", "-"), e)
+            return False
+
+    if not site["cgroup"].strip():
+        for opt in LIMIT_CHECKS:
+            if getattr(opts, opt):
+                _LOGGER.error(
+                    "--%s requires container.cgroup to be set",
+                    opt.replace("_", "-"),
+                )
+                return False
+
+    return True
+
+def resource_limits(opts):
+    """Return the limit files (see limit_files) for the resource limits
+    in opts, and the number of parallel jobs that they allow."""
+    limits = limit_files(
+        cpus=opts.cpus,
+        cpuset=opts.cpuset,
+        memory_max=opts.memory_max,
+        io_weight=opts.io_weight,
+    )
+
+    if opts.cpus:
+        jobs = max(1, math.ceil(float(opts.cpus)))
+    elif opts.cpuset:
+        jobs = cpuset_size(opts.cpuset)
+    else:
+        jobs = None
+
+    return limits, jobs
+
+class Cgroup:
+    def __init__(self, path, limits=None):
+        self.path = path
+        # The limits that were applied to it (see limit_files)
+        self.limits = limits or {}
+
+    @classmethod
+    def create(cls, name, limits=None):
+        """Create a new child named name underneath the delegated cgroup
+        given in the site configuration, applying the given limits (as
+        returned by limit_files). Returns None if cgroups are not
+        configured or not usable and no limits were requested. Raises
+        OSError if any of the limits cannot be applied."""
+        base = _base()
+        if not base:
+            if limits:
+                raise OSError(
+                    "resource limits require container.cgroup to be set"
+                )
+            return None
+
+        path = base / f"{name}.{os.getpid()}"
+        try:
+            enabled = _enabled_controllers(base)
+            path.mkdir()
+        except OSError as e:
+            if limits:
+                raise
+            _LOGGER.warning("Could not create cgroup %s: %s", path, e)
+            return None
+
+        cgroup = cls(path, limits)
+        for filename, value in (limits or {}).items():
+            controller = filename.split(".")[0]
+            try:
+                if controller not in enabled:
+                    raise OSError(
+                        f"the {controller} controller is not enabled in {base}"
+                    )
+                (path / filename).write_text(value)
+            except OSError as e:
+                cgroup.remove()
+                raise OSError(
+                    f"could not set {filename} = {value}: {e}"
+                ) from e
+
+        return cgroup
+
+    def attach(self, *pids):
+        for pid in pids:
+            (self.path / "cgroup.procs").write_text(str(pid))
+
+    def stats(self):
+        stats = {}
+        try:
+            cpu = _read_flat(self.path / "cpu.stat")
+            stats["cpu_usec"] = cpu.get("usage_usec", 0)
+            stats["user_usec"] = cpu.get("user_usec", 0)
+            stats["system_usec"] = cpu.get("system_usec", 0)
+        except (OSError, ValueError) as e:
+            _LOGGER.debug("cpu.stat: %s", e)
+
+        try:
+            stats["memory_peak"] = int(
+                (self.path / "memory.peak").read_text()
+            )
+        except (OSError, ValueError) as e:
+            # Only available since Linux 5.19
+            _LOGGER.debug("memory.peak: %s", e)
+
+        try:
+            io = _read_io(self.path / "io.stat")
+            stats["io_rbytes"] = io.get("rbytes", 0)
+            stats["io_wbytes"] = io.get("wbytes", 0)
+        except (OSError, ValueError) as e:
+            _LOGGER.debug("io.stat: %s", e)
+
+        return stats
+
+    def remove(self):
+        try:
+            self.path.rmdir()
+        except OSError as e:
+            _LOGGER.warning("Could not remove cgroup %s: %s", self.path, e)
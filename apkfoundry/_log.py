@@ -1,11 +1,16 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # Copyright (c) 2019-2020 Max Rees
 # See LICENSE for more information.
+import atexit       # register
 import enum         # Enum
+import fcntl        # flock, LOCK_EX
+import json         # dump, load
 import logging      # Formatter, getLogger, StreamHandler
 import datetime     # datetime
-import os           # environ, isatty
-import sys          # stderr
+import os           # environ, getpid, isatty, path, replace
+import sys          # argv, stderr
+import threading    # get_ident
+import time         # time
 
 # Custom log levels
 # Always use the wrapper functions!
@@ -97,24 +102,86 @@ def msg2(logger, s, *args, **kwargs):
         for i in s:
             logger.log(_MSG2, i, *args, **kwargs)
 
+# Sections are also recorded as Chrome Trace Event "complete" events
+# if $AF_TRACE names a file (or enable_trace() was called). Events are
+# merged into the file at exit, so several processes of the same
+# pipeline can share it.
+_TRACE_FILE = None
+_TRACE_EVENTS = []
+
+def _trace_time():
+    # Microseconds
+    return int(time.time() * 1000000)
+
+def _trace_write():
+    tmp = f"{_TRACE_FILE}.{os.getpid()}"
+    try:
+        with open(f"{_TRACE_FILE}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(_TRACE_FILE) as f:
+                    trace = json.load(f)
+            except (FileNotFoundError, ValueError):
+                trace = {"traceEvents": [], "displayTimeUnit": "ms"}
+            trace["traceEvents"].extend(_TRACE_EVENTS)
+
+            with open(tmp, "w") as f:
+                json.dump(trace, f)
+            os.replace(tmp, _TRACE_FILE)
+    except OSError as e:
+        logging.getLogger(__name__).warning(
+            "Could not write trace to %s: %s", _TRACE_FILE, e,
+        )
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    _TRACE_EVENTS.clear()
+
+def enable_trace(path):
+    """Record sections to the Chrome Trace Event JSON file at path.
+    $AF_TRACE is set accordingly so that child processes record theirs
+    to the same file."""
+    global _TRACE_FILE # pylint: disable=global-statement
+    if _TRACE_FILE is None:
+        atexit.register(_trace_write)
+        _TRACE_EVENTS.append({
+            "name": "process_name", "ph": "M",
+            "pid": os.getpid(), "tid": threading.get_ident(),
+            "args": {"name": " ".join(sys.argv)},
+        })
+    _TRACE_FILE = os.path.abspath(path)
+    os.environ["AF_TRACE"] = _TRACE_FILE
+
+if os.environ.get("AF_TRACE"):
+    enable_trace(os.environ["AF_TRACE"])
+
 _SECTIONS = []
-def section_start(logger, name, *args, **kwargs):
+def section_start(logger, name, *args, trace=None, **kwargs):
     if not logger or isinstance(logger, str):
         logger = logging.getLogger(logger)
 
-    _SECTIONS.append(name)
+    _SECTIONS.append((name, _trace_time(), trace or {}))
     ts = str(int(datetime.datetime.now().timestamp()))
 
     logger.log(_SECTION_START, args[0], "start", ts, name, *args[1:], **kwargs)
 
-def section_end(logger, *args, **kwargs):
+def section_end(logger, *args, trace=None, **kwargs):
     if not logger or isinstance(logger, str):
         logger = logging.getLogger(logger)
 
     if not args:
         args = [""]
 
-    name = _SECTIONS.pop()
+    name, start, meta = _SECTIONS.pop()
     ts = str(int(datetime.datetime.now().timestamp()))
 
+    if _TRACE_FILE:
+        _TRACE_EVENTS.append({
+            "name": name, "cat": "section", "ph": "X",
+            "ts": start, "dur": _trace_time() - start,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+            "args": {**meta, **(trace or {})},
+        })
+
     logger.log(_SECTION_END, args[0], "end", ts, name, *args[1:], **kwargs)
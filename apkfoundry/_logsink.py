@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import collections # deque
+import gzip        # compress, GzipFile
+import logging     # getLogger
+import os          # close, pipe
+import re          # compile, IGNORECASE
+import threading   # Thread
+
+_LOGGER = logging.getLogger(__name__)
+
+# Logs are written as a series of independent gzip members of about
+# _BLOCK_SIZE uncompressed bytes each, so the result is still a normal
+# .gz file. The accompanying .idx file has one line per member:
+#
+# UNCOMPRESSED_OFFSET COMPRESSED_OFFSET FIRST_LINE
+#
+# which allows reading from any line without decompressing everything
+# before it.
+_BLOCK_SIZE = 1 << 20
+_ERROR_LINE = re.compile(
+    rb"\berror\b|\bfail(ed|ure)?\b|\bundefined reference\b",
+    re.IGNORECASE,
+)
+_CONTEXT = 3
+_MAX_ERROR_LINES = 500
+
+def index_path(path):
+    return path.with_name(path.name + ".idx")
+
+def read_lines(path, start=0):
+    """Yield the lines of the compressed log at path, beginning with
+    line number start (counting from 0)."""
+    with open(index_path(path)) as f:
+        index = [tuple(map(int, line.split())) for line in f]
+
+    offset, lineno = 0, 0
+    for _, coffset, first in index:
+        if first > start:
+            break
+        offset, lineno = coffset, first
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        with gzip.GzipFile(fileobj=f) as gz:
+            for line in gz:
+                if lineno >= start:
+                    yield line
+                lineno += 1
+
+class LogSink:
+    """Receive the output of a build through a pipe, store it compressed
+    at path, and only copy a bounded amount of it to out: lines that
+    look like errors (with some context), and the last tail lines once
+    the build is done."""
+
+    def __init__(self, path, out, tail=100):
+        self.path = path
+        self.out = out
+        self.lines = 0
+
+        self._tail = collections.deque(maxlen=tail)
+        self._before = collections.deque(maxlen=_CONTEXT)
+        self._after = 0
+        self._shown = 0
+        self._last_shown = -1
+
+        self._block = bytearray()
+        self._block_line = 0
+        self._offset = 0
+        self._rfd = self._wfd = None
+        self._thread = None
+        self._file = self._index = None
+
+    def start(self):
+        """Create the log and return the keyword arguments to pass to
+        Container.run. finish must be called afterwards, even if this
+        raises OSError."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "wb")
+        self._index = open(index_path(self.path), "w")
+        self._rfd, self._wfd = os.pipe()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+        return {"stdout": self._wfd, "stderr": self._wfd}
+
+    def _read(self):
+        with open(self._rfd, "rb") as f:
+            for line in f:
+                self._line(line)
+
+    def _emit(self, lineno, line):
+        if lineno <= self._last_shown:
+            return
+        if lineno > self._last_shown + 1:
+            self.out.write(
+                b"[... %d lines ...]\n" % (lineno - self._last_shown - 1)
+            )
+        self.out.write(line)
+        self._last_shown = lineno
+
+    def _line(self, line):
+        lineno = self.lines
+        self.lines += 1
+        self._block += line
+        if len(self._block) >= _BLOCK_SIZE:
+            self._flush()
+
+        if self._shown < _MAX_ERROR_LINES and _ERROR_LINE.search(line):
+            for i in self._before:
+                self._emit(*i)
+            self._before.clear()
+            self._emit(lineno, line)
+            self._after = _CONTEXT
+            self._shown += 1
+        elif self._after:
+            self._emit(lineno, line)
+            self._after -= 1
+        else:
+            self._before.append((lineno, line))
+        self._tail.append((lineno, line))
+
+    def _flush(self):
+        if not self._block:
+            return
+
+        self._index.write(
+            f"{self._offset} {self._file.tell()} {self._block_line}\n"
+        )
+        self._file.write(gzip.compress(bytes(self._block)))
+        self._offset += len(self._block)
+        self._block_line = self.lines
+        self._block.clear()
+
+    def finish(self):
+        """Wait for the build output to end, then write the rest of the
+        log and show its tail."""
+        if self._thread is None:
+            # start failed
+            for f in (self._file, self._index):
+                if f is not None:
+                    f.close()
+            return
+
+        os.close(self._wfd)
+        self._thread.join()
+
+        self._flush()
+        self._file.close()
+        self._index.close()
+
+        for i in self._tail:
+            self._emit(*i)
+        self.out.flush()
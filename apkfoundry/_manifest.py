@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import json    # dump, load
+import logging # getLogger
+import os      # getpid, replace
+import re      # compile
+
+import apkfoundry._util as _util
+
+_LOGGER = logging.getLogger(__name__)
+
+# The run-level manifest, written to the container directory (not to
+# REPODEST, which is published), has the form:
+#
+# {
+#   "complete": true,
+#   "builds": {
+#     "STARTDIR": {
+#       "packages": [
+#         {"name": ..., "version": ..., "path": ..., "size": ...,
+#          "sha256": ...},
+#         ...
+#       ],
+#       "logs": ["REPO/ARCH/logs/NAME-VERSION.log", ...]
+#     },
+#     ...
+#   },
+#   "indexes": ["REPO/ARCH/APKINDEX.tar.gz", ...]
+# }
+#
+# All paths are relative to REPODEST. "complete" is false if any
+# successful build did not report what it produced (e.g. because the
+# build script does not use af_abuild).
+MANIFEST_FILE = "af/af-manifest.json"
+_REPODEST = "af/config/repodest"
+_APK_NAME = re.compile(r"^(?P<name>.+)-(?P<version>[^-]+-r[0-9]+)\.apk$")
+
+def _package(repodest, path):
+    filename = repodest / path
+    match = _APK_NAME.match(filename.name)
+    if not match:
+        _LOGGER.warning("%s: could not parse package file name", path)
+        name = version = None
+    else:
+        name, version = match.group("name", "version")
+
+    return {
+        "name": name,
+        "version": version,
+        "path": path,
+        "size": filename.stat().st_size,
+        "sha256": _util.hash_file(filename).hexdigest(),
+    }
+
+def build_manifest(repodest, paths):
+    """Describe the files listed by af_abuild for a single build. Paths
+    that do not exist are skipped."""
+    manifest = {"packages": [], "logs": []}
+    for path in paths:
+        if not (repodest / path).is_file():
+            _LOGGER.warning("%s: listed but not found", path)
+        elif path.endswith(".apk"):
+            manifest["packages"].append(_package(repodest, path))
+        elif path.endswith(".log"):
+            manifest["logs"].append(path)
+
+    return manifest
+
+def index_dirs(builds):
+    """Return the REPO/ARCH directories that received packages from the
+    given builds."""
+    return sorted({
+        package["path"].rsplit("/", maxsplit=1)[0]
+        for build in builds.values() for package in build["packages"]
+    })
+
+def write(cdir, builds, complete):
+    manifest = {
+        "complete": complete,
+        "builds": builds,
+        "indexes": [i + "/APKINDEX.tar.gz" for i in index_dirs(builds)],
+    }
+
+    path = cdir / MANIFEST_FILE
+    tmp = path.with_name(f".{path.name}.{os.getpid()}")
+    try:
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        _LOGGER.warning("Could not write %s: %s", path.name, e)
+
+def load(cdir, since=None):
+    """Return the manifest of the last run, or None if there is none or
+    it is older than since."""
+    path = cdir / MANIFEST_FILE
+    try:
+        if since is not None and path.stat().st_mtime <= since:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        _LOGGER.debug("%s: %s", path.name, e)
+        return None
+
+def refresh(cdir, manifest):
+    """Update the sizes and checksums in manifest after the packages
+    have been modified (e.g. re-signed) and write it back."""
+    repodest = cdir / _REPODEST
+    for build in manifest["builds"].values():
+        build["packages"] = [
+            _package(repodest, package["path"])
+            for package in build["packages"]
+            if (repodest / package["path"]).is_file()
+        ]
+    write(cdir, manifest["builds"], manifest["complete"])
@@ -0,0 +1,184 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import atexit    # register
+import bisect    # bisect_left
+import glob      # glob
+import logging   # getLogger
+import os        # getpid, path.abspath, path.expandvars, replace, stat,
+                 # unlink
+import re        # compile
+import threading # Lock
+import time      # time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Metrics are kept in memory and written in the Prometheus text
+# exposition format to the file given to enable(), e.g. in the
+# directory read by the textfile collector of node_exporter. The file
+# is replaced atomically so that it is never read half-written.
+_PREFIX = "apkfoundry_"
+_INF = float("inf")
+# Environment variables in the path, as expanded by os.path.expandvars
+_ENV_VAR = re.compile(r"\$(\w+|\{[^}]*\})")
+# Upper bounds of the histogram buckets, in seconds
+_LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, _INF,
+)
+_BUILD_BUCKETS = (
+    30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800, _INF,
+)
+
+# name: (type, help, buckets)
+_METRICS = {
+    "builds": (
+        "gauge", "Builds of the current job by status.", None,
+    ),
+    "build_duration_seconds": (
+        "histogram", "Time taken by each build by status.", _BUILD_BUCKETS,
+    ),
+    "container_refreshes_total": (
+        "counter", "Number of times the refresh script was run.", None,
+    ),
+    "container_spawn_seconds": (
+        "histogram", "Time taken to start a container until it is released"
+        " to run its command.", _LATENCY_BUCKETS,
+    ),
+    "rootfs_cache_total": (
+        "counter", "Rootfs tarball lookups by result (hit or miss).", None,
+    ),
+    "sudo_request_seconds": (
+        "histogram", "Time taken to handle af-sudo requests by command.",
+        _LATENCY_BUCKETS,
+    ),
+}
+
+class Histogram:
+    """Number of observed values in each of the given buckets (by upper
+    bound, the last of which must be infinity), their number and their
+    sum."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def cumulative(self):
+        """Yield the upper bound of each bucket with the number of
+        values that are less than or equal to it."""
+        count = 0
+        for bound, n in zip(self.buckets, self.counts):
+            count += n
+            yield bound, count
+
+_lock = threading.Lock()
+_values = {}
+_path = None
+
+def enable(path, expire=None):
+    """Write the metrics to path after each build and at exit.
+    Environment variables in path are expanded. If expire is given,
+    files matching path with other values of these variables that have
+    not been written to in that many seconds are removed first."""
+    global _path # pylint: disable=global-statement
+    if _path is None:
+        atexit.register(write)
+    _path = os.path.abspath(os.path.expandvars(path))
+
+    if expire is not None and _ENV_VAR.search(path):
+        _expire(os.path.abspath(_ENV_VAR.sub("*", path)), expire)
+
+def _expire(pattern, seconds):
+    # Files of earlier jobs would be exported forever otherwise
+    cutoff = time.time() - seconds
+    for path in glob.glob(pattern):
+        if path == _path:
+            continue
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            _LOGGER.warning("Could not remove %s: %s", path, e)
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    key = _key(labels)
+    with _lock:
+        samples = _values.setdefault(name, {})
+        samples[key] = samples.get(key, 0) + value
+
+def gauge(name, value, **labels):
+    with _lock:
+        _values.setdefault(name, {})[_key(labels)] = value
+
+def observe(name, value, **labels):
+    buckets = _METRICS[name][2]
+    key = _key(labels)
+    with _lock:
+        samples = _values.setdefault(name, {})
+        if key not in samples:
+            samples[key] = Histogram(buckets)
+        samples[key].observe(value)
+
+def _fmt(value):
+    if value == _INF:
+        return "+Inf"
+    return repr(value)
+
+def _labels(key, **extra):
+    labels = [*key, *extra.items()]
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '%s="%s"' % (
+            name,
+            str(value).replace("\\", r"\\").replace('"', r"\"")
+            .replace("\n", r"\n"),
+        ) for name, value in labels
+    ) + "}"
+
+def render():
+    lines = []
+    with _lock:
+        for name, samples in sorted(_values.items()):
+            kind, desc, _ = _METRICS[name]
+            name = _PREFIX + name
+            lines.append(f"# HELP {name} {desc}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for key, value in sorted(samples.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(key)} {_fmt(value)}")
+                    continue
+
+                for bound, count in value.cumulative():
+                    lines.append(
+                        f"{name}_bucket{_labels(key, le=_fmt(bound))}"
+                        f" {count}"
+                    )
+                lines.append(f"{name}_sum{_labels(key)} {_fmt(value.total)}")
+                lines.append(f"{name}_count{_labels(key)} {value.count}")
+
+    return "".join(line + "\n" for line in lines)
+
+def write():
+    if _path is None:
+        return
+
+    tmp = f"{_path}.{os.getpid()}"
+    try:
+        with open(tmp, "w") as f:
+            f.write(render())
+        os.replace(tmp, _path)
+    except OSError as e:
+        _LOGGER.warning("Could not write metrics to %s: %s", _path, e)
@@ -1,44 +1,107 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # Copyright (c) 2018-2020 Max Rees
 # See LICENSE for more information.
-import hashlib        # sha256
+import http.client    # HTTPException
+import json           # dump, load
 import logging        # getLogger
-import mmap           # ACCESS_READ, mmap
-import resource       # getpagesize
-import shutil         # copyfileobj
+import os             # replace
 import urllib.parse   # urlparse
-import urllib.request # urlopen
 from pathlib import Path
 
 import apkfoundry # ROOTFS_CACHE
+import apkfoundry._metrics as _metrics
+import apkfoundry._util as _util
 
 _LOGGER = logging.getLogger(__name__)
-_PAGESZ = resource.getpagesize()
+_DOWNLOAD_TRIES = 3
+
+def _verified_path(filename):
+    return filename.with_name(filename.name + ".verified")
+
+def _verified_key(st):
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "inode": st.st_ino,
+    }
+
+def _read_verified(filename, st):
+    try:
+        with open(_verified_path(filename)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(record, dict):
+        return None
+    if any(record.get(k) != v for k, v in _verified_key(st).items()):
+        return None
+    return record.get("sha256")
+
+def _write_verified(filename, st, digest):
+    record = _verified_key(st)
+    record["sha256"] = digest
+
+    verified = _verified_path(filename)
+    tmp = verified.with_name(verified.name + ".tmp")
+    try:
+        with open(tmp, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp, verified)
+    except OSError as e:
+        _LOGGER.warning("%s: could not save verification: %s", verified.name, e)
 
 def _file_sha256(filename, old):
-    with open(filename, "r") as f:
-        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-            new = hashlib.sha256()
-            chunk = mm.read(_PAGESZ)
-            while chunk:
-                new.update(chunk)
-                chunk = mm.read(_PAGESZ)
+    st = filename.stat()
+    if _read_verified(filename, st) == old:
+        _LOGGER.info("%s: OK (previously verified)", filename.name)
+        return True
 
-    new = new.hexdigest()
+    new = _util.hash_file(filename).hexdigest()
     if old != new:
         _LOGGER.error("%s: sha256 does NOT match", filename.name)
         filename.unlink()
+        try:
+            _verified_path(filename).unlink()
+        except FileNotFoundError:
+            pass
         return False
 
+    _write_verified(filename, st, new)
     _LOGGER.info("%s: OK", filename.name)
     return True
 
-def _download_rootfs(url, filename):
+def _partial_path(filename):
+    return filename.with_name(filename.name + ".part")
+
+def _download_rootfs(url, filename, sha256):
     apkfoundry.ROOTFS_CACHE.mkdir(parents=True, exist_ok=True)
+    part = _partial_path(filename)
     _LOGGER.info("Downloading %s...", filename.name)
-    with open(filename, "wb") as f:
-        with urllib.request.urlopen(url) as response:
-            shutil.copyfileobj(response, f)
+
+    for attempt in range(1, _DOWNLOAD_TRIES + 1):
+        try:
+            new = _util.download_chunks(url, part)
+            break
+        except (OSError, http.client.HTTPException) as e:
+            _LOGGER.warning(
+                "%s: download interrupted (attempt %d/%d): %s",
+                filename.name, attempt, _DOWNLOAD_TRIES, e,
+            )
+    else:
+        _LOGGER.error("%s: download failed", filename.name)
+        return False
+
+    new = new.hexdigest()
+    if sha256 != new:
+        _LOGGER.error("%s: sha256 does NOT match", filename.name)
+        part.unlink()
+        return False
+
+    os.replace(part, filename)
+    _write_verified(filename, filename.stat(), new)
+    _LOGGER.info("%s: OK", filename.name)
+    return True
 
 def _get_rootfs(conf, arch):
     url = conf.get("rootfs.url." + arch, "").strip()
@@ -58,11 +121,18 @@ def _get_rootfs(conf, arch):
         return None
 
     cached = apkfoundry.ROOTFS_CACHE / name
-    if not cached.is_file():
-        _download_rootfs(url, cached)
-
-    if not _file_sha256(cached, sha256):
-        return None
+    # Only one process downloads and verifies a given tarball; the rest
+    # wait and then reuse the verified result
+    with _util.lock_file(cached.with_name(cached.name + ".lock")):
+        if not cached.is_file():
+            _metrics.inc("rootfs_cache_total", result="miss")
+            if not _download_rootfs(url, cached, sha256):
+                return None
+        elif not _file_sha256(cached, sha256):
+            _metrics.inc("rootfs_cache_total", result="miss")
+            return None
+        else:
+            _metrics.inc("rootfs_cache_total", result="hit")
 
     return cached
 
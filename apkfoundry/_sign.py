@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import concurrent.futures # ProcessPoolExecutor
+import gzip               # compress
+import logging            # getLogger
+import os                 # fsync, replace
+import shutil             # copyfileobj, copymode
+import subprocess         # PIPE, run
+import tarfile            # TarInfo, USTAR_FORMAT
+import time               # time
+import zlib               # decompressobj, MAX_WBITS
+from pathlib import Path
+
+_LOGGER = logging.getLogger(__name__)
+
+# Both .apk files and APKINDEX.tar.gz consist of concatenated gzip
+# streams:
+#
+# * Zero or more signature streams, each a tar file holding .SIGN.*
+# * The signed stream (control.tar.gz or the index itself)
+# * For .apk files, the data stream
+#
+# Re-signing replaces the signature streams with a new one and leaves
+# the rest untouched.
+_SIGN_PREFIX = b".SIGN."
+_BLOCK = 512
+_CHUNK = 64 * 1024
+
+def _find_signed(f):
+    # Returns the offsets of the start and end of the signed stream
+    offset = 0
+    while True:
+        f.seek(offset)
+        # The stream ends at the end of the first gzip member, so the
+        # data stream of an .apk is never read
+        stream = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        head = b""
+        read = 0
+        while not stream.eof:
+            chunk = f.read(_CHUNK)
+            if not chunk:
+                if not read:
+                    raise ValueError("no signable gzip stream found")
+                raise ValueError("truncated gzip stream")
+            read += len(chunk)
+            out = stream.decompress(chunk)
+            if len(head) < len(_SIGN_PREFIX):
+                head += out[:len(_SIGN_PREFIX)]
+
+        end = offset + read - len(stream.unused_data)
+        if not head.startswith(_SIGN_PREFIX):
+            return offset, end
+        offset = end
+
+def _signature(signed, privkey, pubkey):
+    sig = subprocess.run(
+        ("openssl", "dgst", "-sha1", "-sign", str(privkey)),
+        input=signed, stdout=subprocess.PIPE, check=True,
+    ).stdout
+
+    info = tarfile.TarInfo(".SIGN.RSA." + Path(pubkey).name)
+    info.size = len(sig)
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    info.uname = info.gname = "root"
+
+    # Like abuild-tar --cut, leave off the end-of-archive blocks so
+    # that the following stream continues the same tar archive
+    tar = info.tobuf(tarfile.USTAR_FORMAT, "utf-8", "surrogateescape")
+    tar += sig + b"\0" * (-len(sig) % _BLOCK)
+    return gzip.compress(tar, compresslevel=9)
+
+def resign_file(path, privkey, pubkey):
+    """Replace the signatures of the .apk or APKINDEX.tar.gz at path
+    with one made using privkey, named after pubkey."""
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.resign")
+    with open(path, "rb") as src:
+        start, end = _find_signed(src)
+        src.seek(start)
+        signed = src.read(end - start)
+        signature = _signature(signed, privkey, pubkey)
+
+        with open(tmp, "wb") as f:
+            f.write(signature)
+            f.write(signed)
+            # The data stream is copied as is
+            shutil.copyfileobj(src, f, _CHUNK)
+            f.flush()
+            os.fsync(f.fileno())
+    shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+
+    return path
+
+def resign(paths, privkey, pubkey, jobs=None):
+    """Re-sign each of the given files in parallel. Returns the number
+    of files that could not be re-signed."""
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(resign_file, path, privkey, pubkey): path
+            for path in paths
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                _LOGGER.error("%s: %s", futures[future].name, e)
+                failed += 1
+
+    return failed
@@ -1,24 +1,31 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # Copyright (c) 2019-2020 Max Rees
 # See LICENSE for more information.
+import array        # array
 import errno        # EBADF
 import logging      # getLogger
 import os           # close, write
-import socket       # CMSG_SPACE, SOL_SOCKET, SCM_RIGHTS, socketpair
-import socketserver # StreamRequestHandler
-import struct       # calcsize, pack, unpack
-import threading    # Thread
+import socket       # AF_UNIX, CMSG_SPACE, SOCK_SEQPACKET, SOL_SOCKET,
+                    # SCM_RIGHTS, socket, socketpair
+import struct       # calcsize, pack
+import threading    # Lock, Thread
+import time         # monotonic
 from pathlib import Path
 
+import apkfoundry           # LIBEXECDIR
 import apkfoundry.container # Container
+import apkfoundry._metrics as _metrics
 
 _LOGGER = logging.getLogger(__name__)
 
-NUM_FDS = 3
+# stdin, stdout, stderr, and the client's end of a private socket on
+# which to send the return code
+NUM_FDS = 4
 PASSFD_FMT = NUM_FDS * "i"
 PASSFD_SIZE = socket.CMSG_SPACE(struct.calcsize(PASSFD_FMT))
 RC_FMT = "i"
 BUF_SIZE = 4096
+EXECUTOR = "af-sudod"
 
 def abuild_fetch(argv):
     expected_argv = (
@@ -54,101 +61,229 @@ COMMANDS = {
     "abuild-adduser": ("/usr/sbin/adduser", lambda _: ...),
 }
 
+# apk subcommands that do not need exclusive access to the database.
+# Everything else that modifies the container is serialized.
+_APK_SHARED = (
+    "fetch",
+    "info",
+    "search",
+    "list",
+    "dot",
+    "policy",
+    "version",
+    "verify",
+    "stats",
+)
+
+def _exclusive(argv):
+    if argv[0] == "abuild-fetch":
+        return False
+    if argv[0] in ("apk", "abuild-apk"):
+        subcmd = next((i for i in argv[1:] if not i.startswith("-")), None)
+        return subcmd not in _APK_SHARED
+    return True
+
 def recv_fds(conn):
     msg, anc, _, _ = conn.recvmsg(
         BUF_SIZE, PASSFD_SIZE
     )
 
+    fds = array.array("i")
     for cmsg in anc:
         if cmsg[0:2] != (socket.SOL_SOCKET, socket.SCM_RIGHTS):
             continue
-        fds = struct.unpack(PASSFD_FMT, cmsg[2])
-        break
-    else:
-        fds = tuple()
+        data = cmsg[2]
+        fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+    return (msg, tuple(fds))
 
-    return (msg, fds)
+def send_fds(conn, argv, fds):
+    conn.sendmsg(
+        ["\0".join(argv).encode("utf-8")],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))],
+    )
 
 def send_retcode(conn, rc):
     conn.send(struct.pack(RC_FMT, rc))
 
+def recv_retcode(conn):
+    rc = conn.recv(BUF_SIZE)
+    if len(rc) < struct.calcsize(RC_FMT):
+        return None
+    return struct.unpack_from(RC_FMT, rc)[0]
+
 def client_init(cdir):
-    server, client = socket.socketpair()
+    server, client = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
     sudo_thread = threading.Thread(
-        target=SudoConn,
-        args=(server, cdir),
+        target=SudoServer(server, cdir).serve_forever,
         daemon=True,
     )
 
     sudo_thread.start()
     return client
 
-class SudoConn(socketserver.StreamRequestHandler):
+class SudoServer:
+    """Accept requests from any number of af-sudo clients at once.
+
+    Each request is a single SOCK_SEQPACKET message, so concurrent
+    clients sharing the same socket cannot interleave. The reply goes
+    out over a private socket passed with the request, and every request
+    is handled in its own thread.
+    """
     def __init__(self, sock, cdir):
         self.cdir = Path(cdir)
-        super().__init__(sock, None, None)
+        self.lock = threading.Lock()
+        self.sock = sock
 
-    def setup(self):
-        super().setup()
-        self.fds = [-1, -1, -1]
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
-    def handle(self):
-        announced = False
+    def serve_forever(self):
+        _LOGGER.debug("Connected")
 
-        while True:
-            self._close_fds()
+        while self._accept():
+            pass
 
-            try:
-                argv, fds = recv_fds(self.request)
-            except ConnectionError:
-                _LOGGER.debug("Disconnected")
-                break
-            if not argv:
-                _LOGGER.debug("Disconnected")
-                break
-
-            if not announced:
-                _LOGGER.debug("Connected")
-                announced = True
-
-            if not fds:
-                self._err("No file descriptors given")
-                continue
-            self.fds = list(fds)
+        self.sock.close()
+        self._stop_executor()
+        _LOGGER.debug("Disconnected")
 
-            argv = argv.decode("utf-8")
-            argv = argv.split("\0")
-            cmd = argv[0]
+    def executor(self):
+        # A single long-lived root process inside the container runs
+        # every command, so each request costs a fork/exec instead of a
+        # whole new container
+        with self._executor_lock:
+            if self._executor and self._executor[0].poll() is None:
+                return self._executor[1]
+            self._stop_executor()
 
-            if cmd not in COMMANDS:
-                self._err("Command not allowed: %s", cmd)
-                continue
+            if not (apkfoundry.LIBEXECDIR / EXECUTOR).is_file():
+                return None
 
-            _LOGGER.debug("Received command: %s", " ".join(argv))
+            ours, theirs = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET,
+            )
+            cont = apkfoundry.container.Container(self.cdir, sudo=False)
+            rc, proc = cont.run(
+                ["/af/libexec/" + EXECUTOR, str(theirs.fileno())],
+                su=True, net=True, ro_root=False, skip_refresh=True,
+                pass_fds=[theirs.fileno()], wait=False,
+            )
+            theirs.close()
+            if rc:
+                _LOGGER.warning("Failed to start %s", EXECUTOR)
+                ours.close()
+                return None
+
+            _LOGGER.debug("Started %s", EXECUTOR)
+            self._executor = (proc, ours)
+            return ours
+
+    def _stop_executor(self):
+        if not self._executor:
+            return
+        proc, sock = self._executor
+        self._executor = None
+
+        # The executor exits once its socket is closed
+        sock.close()
+        proc.wait()
+
+    def _accept(self):
+        try:
+            argv, fds = recv_fds(self.sock)
+        except ConnectionError:
+            return False
+        if not (argv or fds):
+            return False
+
+        conn = SudoConn(self, argv, fds)
+        threading.Thread(target=conn.handle, daemon=True).start()
+        return True
+
+class SudoConn:
+    def __init__(self, server, argv, fds):
+        self.server = server
+        self.cdir = server.cdir
+        self.argv = argv
+        self.fds = list(fds)
+        self.reply = None
 
-            try:
-                COMMANDS[cmd][1](argv[1:])
-            except ValueError as e:
-                self._err("%s", e)
-                continue
-            argv[0] = COMMANDS[cmd][0]
+    def handle(self):
+        try:
+            self._handle()
+        finally:
+            self._close_fds()
 
-            try:
-                cont = apkfoundry.container.Container(self.cdir, sudo=False)
-                rc, _ = cont.run(
-                    argv,
-                    su=True, net=True, ro_root=False, skip_refresh=True,
-                    stdin=self.fds[0], stdout=self.fds[1], stderr=self.fds[2],
-                )
+    def _handle(self):
+        if len(self.fds) != NUM_FDS:
+            # Can't even reply to this
+            _LOGGER.error(
+                "Expected %d file descriptors, got %d",
+                NUM_FDS, len(self.fds),
+            )
+            return
+        self.reply = socket.socket(fileno=self.fds.pop())
+
+        argv = self.argv.decode("utf-8")
+        argv = argv.split("\0")
+        cmd = argv[0]
+
+        if cmd not in COMMANDS:
+            self._err("Command not allowed: %s", cmd)
+            return
 
-                send_retcode(self.request, rc)
-            except ConnectionError:
-                pass
+        _LOGGER.debug("Received command: %s", " ".join(argv))
 
-    def finish(self):
-        self._close_fds()
+        try:
+            COMMANDS[cmd][1](argv[1:])
+        except ValueError as e:
+            self._err("%s", e)
+            return
+
+        start = time.monotonic()
+        if _exclusive(argv):
+            with self.server.lock:
+                rc = self.run([COMMANDS[cmd][0], *argv[1:]])
+        else:
+            rc = self.run([COMMANDS[cmd][0], *argv[1:]])
+        _metrics.observe(
+            "sudo_request_seconds", time.monotonic() - start, command=cmd,
+        )
+
+        try:
+            send_retcode(self.reply, rc)
+        except ConnectionError:
+            pass
+
+    def run(self, argv):
+        executor = self.server.executor()
+        if executor:
+            ours, theirs = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET,
+            )
+            with ours:
+                with theirs:
+                    send_fds(executor, argv, [*self.fds[:3], theirs.fileno()])
+                rc = recv_retcode(ours)
+            if rc is None:
+                _LOGGER.error("%s did not return a status", EXECUTOR)
+                return 1
+            return rc
+
+        cont = apkfoundry.container.Container(self.cdir, sudo=False)
+        rc, _ = cont.run(
+            argv,
+            su=True, net=True, ro_root=False, skip_refresh=True,
+            stdin=self.fds[0], stdout=self.fds[1], stderr=self.fds[2],
+        )
+        return rc
 
     def _close_fds(self):
+        if self.reply:
+            self.reply.close()
+            self.reply = None
+
         for i, fd in enumerate(self.fds):
             if fd == -1:
                 continue
@@ -168,7 +303,7 @@ class SudoConn(socketserver.StreamRequestHandler):
             pass
 
         try:
-            send_retcode(self.request, 1)
+            send_retcode(self.reply, 1)
         except ConnectionError:
             pass
 
@@ -0,0 +1,103 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import collections # defaultdict
+import contextlib  # contextmanager
+import functools   # wraps
+import logging     # getLogger
+import os          # environ
+import time        # perf_counter
+
+import apkfoundry._log as _log
+import apkfoundry._metrics as _metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+_BUCKETS = (
+    0.001, 0.002, 0.005,
+    0.01, 0.02, 0.05,
+    0.1, 0.2, 0.5,
+    1, 2, 5,
+    10, 20, 50,
+    float("inf"),
+)
+_BAR_WIDTH = 40
+
+_enabled = bool(os.environ.get("AF_TIMING"))
+_samples = collections.defaultdict(list)
+
+def enable(enabled=True):
+    global _enabled # pylint: disable=global-statement
+    _enabled = enabled
+
+def reset():
+    _samples.clear()
+
+@contextlib.contextmanager
+def phase(name):
+    """Record the wall time spent in the body under name, if timing
+    has been enabled with enable() or $AF_TIMING."""
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _samples[name].append(time.perf_counter() - start)
+
+def timed(name):
+    """Decorator version of phase()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def _fmt(seconds):
+    if seconds == float("inf"):
+        return "inf"
+    if seconds < 1:
+        return f"{seconds * 1000:g}ms"
+    return f"{seconds:g}s"
+
+def histogram(values):
+    hist = _metrics.Histogram(_BUCKETS)
+    for value in values:
+        hist.observe(value)
+    return hist.counts
+
+def report(logger=_LOGGER):
+    if not _samples:
+        return
+
+    _log.section_start(logger, "timing", "Timing by phase:")
+    for name, values in sorted(_samples.items()):
+        values = sorted(values)
+        logger.info(
+            "%s: n=%d total=%.3fs mean=%.1fms p50=%.1fms p95=%.1fms max=%.1fms",
+            name, len(values), sum(values),
+            sum(values) / len(values) * 1000,
+            _percentile(values, 50) * 1000,
+            _percentile(values, 95) * 1000,
+            values[-1] * 1000,
+        )
+
+        counts = histogram(values)
+        first = next(i for i, n in enumerate(counts) if n)
+        last = max(i for i, n in enumerate(counts) if n)
+        most = max(counts)
+        for i in range(first, last + 1):
+            _log.msg2(
+                logger, "<= %-6s %6d %s",
+                _fmt(_BUCKETS[i]), counts[i],
+                "#" * -(-counts[i] * _BAR_WIDTH // most),
+            )
+    _log.section_end(logger)
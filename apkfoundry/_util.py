@@ -1,12 +1,25 @@
 # SPDX-License-Identifier: GPL-2.0-only
 # Copyright (c) 2019-2020 Max Rees
 # See LICENSE for more information.
-import os           # environ
-import subprocess   # check_call, check_output
-import sys          # stderr, stdout
+import contextlib     # contextmanager
+import fcntl          # flock, LOCK_*
+import hashlib        # new
+import http.client    # IncompleteRead, PARTIAL_CONTENT,
+                      # REQUESTED_RANGE_NOT_SATISFIABLE
+import logging        # getLogger
+import mmap           # ACCESS_READ, mmap
+import os             # environ, fstat, path.abspath, path.relpath
+import resource       # getpagesize
+import subprocess     # check_call, check_output
+import sys            # stderr, stdout
+import urllib.error   # HTTPError
+import urllib.request # Request, urlopen
 from pathlib import Path
 
-import apkfoundry   # CACHEDIR
+import apkfoundry     # CACHEDIR
+
+_LOGGER = logging.getLogger(__name__)
+_HASH_CHUNK = 256 * resource.getpagesize()
 
 def check_call(args, **kwargs):
     args = [str(arg) for arg in args]
@@ -14,6 +27,93 @@ def check_call(args, **kwargs):
     sys.stderr.flush()
     return subprocess.check_call(args, **kwargs)
 
+@contextlib.contextmanager
+def lock_file(path, shared=False, blocking=True):
+    # Single-flight coordination for shared caches: the first process
+    # populates the entry while the others block here, then reuse it.
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not blocking:
+                raise
+            _LOGGER.info("Waiting for lock on %s...", path.name)
+            fcntl.flock(f, mode)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def hash_file(filename, algo="sha256"):
+    new = hashlib.new(algo)
+    with open(filename, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return new
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as view:
+            for i in range(0, len(view), _HASH_CHUNK):
+                new.update(view[i:i + _HASH_CHUNK])
+
+    return new
+
+def download_chunks(url, part, algo="sha256"):
+    offset = part.stat().st_size if part.is_file() else 0
+    request = urllib.request.Request(url)
+    if offset and request.type in ("http", "https"):
+        request.add_header("Range", f"bytes={offset}-")
+
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code != http.client.REQUESTED_RANGE_NOT_SATISFIABLE:
+            raise
+        # The partial file is no good; start over
+        _LOGGER.warning("%s: cannot resume download", part.name)
+        part.unlink()
+        return download_chunks(url, part, algo)
+
+    with response:
+        if offset and response.status == http.client.PARTIAL_CONTENT:
+            _LOGGER.info("Resuming %s at byte %d...", part.name, offset)
+            new = hash_file(part, algo)
+            mode = "ab"
+        else:
+            new = hashlib.new(algo)
+            mode = "wb"
+
+        with open(part, mode) as f:
+            chunk = response.read(_HASH_CHUNK)
+            while chunk:
+                f.write(chunk)
+                new.update(chunk)
+                chunk = response.read(_HASH_CHUNK)
+
+        # http.client does not complain about a short read when reading
+        # in chunks
+        remaining = getattr(response, "length", None)
+        if remaining:
+            raise http.client.IncompleteRead(b"", remaining)
+
+    return new
+
+def symlink(link, target, cdir):
+    # Links that point inside the container are kept relative so that
+    # the container can be moved (e.g. when claimed from a pool)
+    target = Path(os.path.abspath(target))
+    cdir = Path(os.path.abspath(cdir))
+    if target == cdir or cdir in target.parents:
+        target = os.path.relpath(target, link.parent)
+
+    if link.is_symlink():
+        link.unlink()
+    link.symlink_to(target)
+
 def get_branch(gitdir=None):
     args = ["git"]
     if gitdir:
@@ -0,0 +1,262 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import argparse   # ArgumentParser
+import contextlib # contextmanager
+import fcntl      # flock, LOCK_*
+import logging    # getLogger
+import os         # link, lstat, path.samefile, readlink, replace, symlink,
+                  # unlink
+from pathlib import Path
+
+import apkfoundry # APK_STORE, DEFAULT_ARCH
+import apkfoundry._util as _util
+
+_LOGGER = logging.getLogger(__name__)
+
+# The store consists of:
+#
+# blobs/XX/SHA256 - the contents of each .apk, named by checksum
+# names/ARCH/NAME - symlink to the blob of the .apk that apk caches as
+#                   NAME for ARCH
+#
+# Each APK cache directory is a view whose entries are hard links to
+# the blobs. A view keeps the packages that were downloaded into it
+# until apk removes them (e.g. with "apk cache clean"). Packages known
+# from other views are only lent to it for the duration of a job and
+# listed in VIEW.borrowed until they are returned, so that a blob is
+# unreferenced once no view that downloaded it still has it, i.e. when
+# its link count drops to 1.
+_BLOBS = "blobs"
+_NAMES = "names"
+_LOCK = ".lock"
+
+def _blob_path(digest):
+    return apkfoundry.APK_STORE / _BLOBS / digest[:2] / digest
+
+def _tmp_path(path):
+    return path.with_name(f".{path.name}.{os.getpid()}")
+
+def _link_name(arch, name, blob):
+    link = apkfoundry.APK_STORE / _NAMES / arch / name
+    target = os.path.relpath(blob, link.parent)
+    try:
+        if os.readlink(link) == target:
+            return
+    except FileNotFoundError:
+        link.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp = _tmp_path(link)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+
+def _replace_with_link(blob, path):
+    tmp = _tmp_path(path)
+    os.link(blob, tmp)
+    os.replace(tmp, path)
+
+def _ingest(view, arch):
+    new = 0
+    for apk in view.glob("*.apk"):
+        st = os.lstat(apk)
+        if st.st_nlink > 1:
+            # Already part of the store
+            continue
+
+        blob = _blob_path(_util.hash_file(apk).hexdigest())
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(apk, blob)
+            new += 1
+        except FileExistsError:
+            # Downloaded again by another cache directory
+            _replace_with_link(blob, apk)
+
+        _link_name(arch, apk.name, blob)
+
+    return new
+
+def _borrowed_path(view):
+    # Outside of view, since apk may remove files it does not know
+    return view.with_name(view.name + ".borrowed")
+
+def _lend(view, arch):
+    names = apkfoundry.APK_STORE / _NAMES / arch
+    if not names.is_dir():
+        return 0
+
+    links = [i for i in names.iterdir() if not (view / i.name).exists()]
+    # Recorded before linking so that nothing is kept by accident if
+    # we are interrupted. Other jobs using the same view may be adding
+    # to the list at the same time
+    with open(_borrowed_path(view), "a") as f:
+        f.write("".join(i.name + "\n" for i in links))
+
+    added = 0
+    for link in links:
+        try:
+            os.link(link.resolve(strict=True), view / link.name)
+            added += 1
+        except (FileNotFoundError, FileExistsError):
+            # Collected in the meantime, or apk got there first
+            continue
+
+    return added
+
+def _return_borrowed(view, arch):
+    borrowed = _borrowed_path(view)
+    try:
+        names = borrowed.read_text().split()
+    except FileNotFoundError:
+        return 0
+
+    returned = 0
+    for name in names:
+        apk = view / name
+        try:
+            # Keep it if apk has replaced it in the meantime
+            if not os.path.samefile(
+                    apk, apkfoundry.APK_STORE / _NAMES / arch / name):
+                continue
+            apk.unlink()
+            returned += 1
+        except FileNotFoundError:
+            continue
+
+    borrowed.unlink()
+    return returned
+
+def sync(view, arch):
+    """Add any new .apk files in the cache directory view to the store,
+    then lend every other .apk known for arch to view until release()
+    is called."""
+    view = Path(view)
+    view.mkdir(parents=True, exist_ok=True)
+
+    with _util.lock_file(apkfoundry.APK_STORE / _LOCK, shared=True):
+        new = _ingest(view, arch)
+        added = _lend(view, arch)
+
+    _LOGGER.info(
+        "APK cache: %d new package(s) stored, %d linked from the store",
+        new, added,
+    )
+
+def release(view, arch, keep=False):
+    """Add any new .apk files in the cache directory view to the store,
+    and unless keep is True, remove the ones that were lent to it by
+    sync()."""
+    view = Path(view)
+    if not view.is_dir():
+        return
+
+    with _util.lock_file(apkfoundry.APK_STORE / _LOCK, shared=True):
+        # Before ingesting, which would turn packages that apk
+        # downloaded again into links indistinguishable from lent ones
+        returned = 0 if keep else _return_borrowed(view, arch)
+        new = _ingest(view, arch)
+
+    _LOGGER.info(
+        "APK cache: %d new package(s) stored, %d returned to the store",
+        new, returned,
+    )
+
+@contextlib.contextmanager
+def borrow(view, arch):
+    """Lend packages to the cache directory view for the duration of
+    the context. Several jobs may use the same view at once, in which
+    case the last one to finish returns them (including any left over
+    by interrupted jobs)."""
+    view = Path(view)
+    view.mkdir(parents=True, exist_ok=True)
+
+    with open(view.with_name(view.name + ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        sync(view, arch)
+        try:
+            yield
+        finally:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                keep = False
+            except BlockingIOError:
+                # Still in use by another job
+                keep = True
+            release(view, arch, keep=keep)
+
+def gc():
+    """Delete every blob that no APK cache directory refers to anymore,
+    along with the names pointing to them."""
+    blobs = apkfoundry.APK_STORE / _BLOBS
+    names = apkfoundry.APK_STORE / _NAMES
+    removed = freed = 0
+
+    with _util.lock_file(apkfoundry.APK_STORE / _LOCK):
+        for blob in blobs.glob("*/*"):
+            st = os.lstat(blob)
+            if st.st_nlink > 1:
+                continue
+            blob.unlink()
+            removed += 1
+            freed += st.st_size
+
+        for link in names.glob("*/*"):
+            if not link.exists():
+                link.unlink()
+
+    _LOGGER.info(
+        "APK cache: removed %d unreferenced package(s), freeing %d KiB",
+        removed, freed // 1024,
+    )
+    return 0
+
+def _apkcache_args(args):
+    opts = argparse.ArgumentParser(
+        usage="af-apkcache [-h] CMD ...",
+        description=f"""Manage the APK download cache shared between
+        projects, branches, and architectures in
+        {apkfoundry.APK_STORE}.""",
+    )
+    cmds = opts.add_subparsers(
+        metavar="CMD", dest="cmd",
+        help="subcommand to run",
+    )
+
+    for name, desc in (
+            ("sync", """store new packages from DIR and lend all other
+            known packages to it"""),
+            ("release", """store new packages from DIR and remove the
+            packages lent to it by sync"""),
+    ):
+        cmd = cmds.add_parser(name, help=desc)
+        cmd.add_argument(
+            "--arch",
+            help=f"""APK architecture name (default:
+            {apkfoundry.DEFAULT_ARCH})""",
+        )
+        cmd.add_argument(
+            "view", metavar="DIR",
+            help="APK cache directory (as passed to --cache-apk)",
+        )
+
+    cmds.add_parser(
+        "gc",
+        help="""delete packages that are no longer present in any APK
+        cache directory""",
+    )
+
+    return opts, opts.parse_args(args)
+
+def apkcache(args):
+    parser, opts = _apkcache_args(args)
+    if opts.cmd == "sync":
+        sync(opts.view, opts.arch or apkfoundry.DEFAULT_ARCH)
+        return 0
+    if opts.cmd == "release":
+        release(opts.view, opts.arch or apkfoundry.DEFAULT_ARCH)
+        return 0
+    if opts.cmd == "gc":
+        return gc()
+
+    parser.print_help()
+    return 1
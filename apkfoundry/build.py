@@ -2,136 +2,183 @@
 # Copyright (c) 2019-2020 Max Rees
 # See LICENSE for more information.
 import argparse   # ArgumentParser, SUPPRESS
-import enum       # Enum, IntFlag, unique
+import enum       # Enum
 import functools  # partial
 import logging    # getLogger
 import os         # access, *_OK
-import re         # compile
 import shutil     # chown, copy2, rmtree
 import subprocess # check_output
 import tempfile   # mkdtemp
-import textwrap   # TextWrapper
-import time       # time
+import time       # monotonic, time
 from pathlib import Path
 
-import apkfoundry           # DEFAULT_ARCH, LOCALSTATEDIR, MOUNTS, proj_conf
+import apkfoundry           # DEFAULT_ARCH, LOCALSTATEDIR, MOUNTS, proj_conf,
+                            # site_conf
 import apkfoundry.container # cont_make
 import apkfoundry.digraph   # generate_graph
+import apkfoundry.distfiles # Prefetcher
+import apkfoundry._abi as _abi
+import apkfoundry._buildenv as _buildenv
+import apkfoundry._buildlog as _buildlog
+import apkfoundry._cgroup as _cgroup
 import apkfoundry._log as _log
+import apkfoundry._manifest as _manifest
+import apkfoundry._metrics as _metrics
+import apkfoundry._sign as _sign
+import apkfoundry._timing as _timing
 import apkfoundry._util as _util
 
 _LOGGER = logging.getLogger(__name__)
 
-@enum.unique
-class Status(enum.IntFlag):
-    DONE = 8
-    ERROR = DONE | 16      # 24
-    CANCEL = ERROR | 32    # 56
-    SUCCESS = DONE | 64    # 72
-    FAIL = ERROR | 128     # 152
-    DEPFAIL = CANCEL | 256 # 312
-
-    # The following (and also CANCEL) are no longer used and may be
-    # removed in a future version.
-    NEW = 1
-    REJECT = 2
-    START = 4
-    SKIP = DONE | 512      # 520
-
-    def __str__(self):
-        return self.name
-
 class FailureAction(enum.Enum):
     STOP = 0
     RECALCULATE = 1
     IGNORE = 2
 
-_REPORT_STATUSES = (
-    Status.SUCCESS,
-    Status.DEPFAIL,
-    Status.FAIL,
-    Status.ERROR,
-    Status.CANCEL,
-)
-_NET_OPTION = re.compile(r"""^options=(["']?)[^"']*\bnet\b[^"']*\1""")
-_wrap = textwrap.TextWrapper()
-
-def _stats_list(status, l):
-    if not l:
-        return
-
-    _LOGGER.info("%s: %d", status.name.title(), len(l))
-    l = _wrap.fill(" ".join(l)).splitlines()
-    for i in l:
-        _log.msg2(_LOGGER, "%s", i)
-
-def _stats_builds(done):
-    _LOGGER.info("Total: %d", len(done))
-
-    statuses = {
-        status: [i for i in done if done[i] == status]
-        for status in _REPORT_STATUSES
-    }
-
-    for status, startdirs in statuses.items():
-        _stats_list(status, startdirs)
-
-    for status in set(_REPORT_STATUSES) - {Status.SUCCESS}:
-        if any(statuses[status]):
-            return 1
-    return 0
-
-def _run_env(cont, startdir):
-    buildbase = Path(apkfoundry.MOUNTS["builddir"]) / startdir
-
-    tmp_real = cont.cdir / "af/config/builddir" / startdir / "tmp"
+class BuildOrder(enum.Enum):
+    DEFAULT = 0
+    AFFINITY = 1
+
+def _count_installs(graph, order):
+    # Rough estimate: each build installs whatever the previous build
+    # did not already have
+    installs = 0
+    prev = set()
+    for startdir in order:
+        deps = set(graph.depnames.get(startdir, ()))
+        installs += len(deps - prev)
+        prev = deps
+    return installs
+
+def _affinity_order(graph, order):
+    """Return the startdirs in order rearranged so that packages with
+    similar dependencies are built back to back. Each step picks, among
+    the packages whose dependencies have all been built, the one whose
+    dependencies overlap the most with those of the previous build."""
+    wanted = {startdir: i for i, startdir in enumerate(order)}
+    indegree = {i: 0 for i in graph.graph}
+    for rdeps in graph.graph.values():
+        for rdep in rdeps:
+            indegree[rdep] += 1
+    ready = [i for i, n in indegree.items() if n == 0]
+
+    def score(startdir):
+        deps = set(graph.depnames.get(startdir, ()))
+        union = len(deps | prev)
+        similarity = len(deps & prev) / union if union else 0
+        return (similarity, -wanted[startdir])
+
+    new = []
+    prev = set()
+    while ready:
+        # Packages that aren't being built cost nothing to get through
+        free = [i for i in ready if i not in wanted]
+        startdir = free[0] if free else max(ready, key=score)
+        ready.remove(startdir)
+
+        if startdir in wanted:
+            new.append(startdir)
+            prev = set(graph.depnames.get(startdir, ()))
+        for rdep in graph.graph[startdir]:
+            indegree[rdep] -= 1
+            if indegree[rdep] == 0:
+                ready.append(rdep)
+
+    return new
+
+def update_index(cont, dirs):
+    """Regenerate the APKINDEX of each of the given REPO/ARCH
+    directories in REPODEST."""
+    _log.section_start(
+        _LOGGER, "index", "Updating %d repository indexes...", len(dirs),
+    )
+    rc, _ = cont.run(
+        ["/af/libexec/af-index", *sorted(dirs)],
+        skip_refresh=True, skip_sudo=True,
+    )
+    if rc != 0:
+        _LOGGER.error("af-index failed with status %d", rc)
+    _log.section_end(_LOGGER)
+    return rc == 0
+
+class BuildResult:
+    """The outcome of a single build, as returned by run_task."""
+
+    def __init__(self, rc):
+        self.rc = rc
+        # Resource usage of its cgroup, if any
+        self.usage = None
+        # What af_abuild reported that it produced (see _manifest)
+        self.manifest = None
+        # Its compressed log relative to REPODEST, if any
+        self.log = None
+
+def run_task(cont, conf, startdir, script, *, skip_refresh=False,
+             limits=None, jobs=None, meta=None, force=False):
+    """Build startdir using script. Returns a BuildResult."""
+    env, tmp, tmpfs_size = _buildenv.task_env(
+        cont, conf, startdir, meta, jobs, force,
+    )
     try:
-        shutil.rmtree(tmp_real.parent)
-    except (FileNotFoundError, PermissionError):
+        (cont.cdir / _buildenv.MANIFEST.lstrip("/")).unlink()
+    except FileNotFoundError:
         pass
-    tmp_real.mkdir(parents=True, exist_ok=True)
-    tmp = str(buildbase / "tmp")
-
-    env = {
-        "HOME": tmp,
-        "TEMP": tmp,
-        "TEMPDIR": tmp,
-        "TMP": tmp,
-        "TMPDIR": tmp,
-
-        "ABUILD_TMP": str(apkfoundry.MOUNTS["builddir"]),
-        # "deps" is a waste of time since world will be refreshed
-        # on next package
-        "CLEANUP": "srcdir pkgdir",
-        "ERROR_CLEANUP": "",
-    }
-
-    return env, tmp_real
-
-def run_task(cont, conf, startdir, script):
-    env, tmp = _run_env(cont, startdir)
-    repo = startdir.split("/")[0]
 
-    APKBUILD = cont.cdir / f"af/config/aportsdir/{startdir}/APKBUILD"
-    net = conf.getboolean("build.networking")
-    if not net:
-        with open(APKBUILD) as f:
-            for line in f:
-                if _NET_OPTION.search(line) is not None:
-                    net = True
-                    break
+    net = _buildenv.task_net(cont, conf, startdir, meta)
     if net:
         _LOGGER.warning("%s: network access enabled", startdir)
 
-    rc, _ = cont.run(
-        [script, startdir],
-        repo=repo,
-        env=env,
-        net=net,
-        chdir=Path(apkfoundry.MOUNTS["aportsdir"]) / startdir,
-    )
+    result = BuildResult(1)
+    kwargs = {}
+    sink = _buildlog.log_sink(cont, conf, startdir, meta)
+    if sink:
+        sink, result.log = sink
+        try:
+            kwargs = sink.start()
+        except OSError as e:
+            _LOGGER.warning("%s: could not create log: %s", startdir, e)
+            sink.finish()
+            sink = result.log = None
+        else:
+            # af_loginit leaves the output alone
+            env["AF_LOG_SINK"] = result.log
+
+    try:
+        cgroup = _cgroup.Cgroup.create(
+            "af-" + startdir.replace("/", "_"), limits,
+        )
+    except OSError as e:
+        _LOGGER.error("%s: %s", startdir, e)
+        if sink:
+            sink.finish()
+        return result
+
+    try:
+        result.rc, _ = cont.run(
+            [script, startdir],
+            repo=startdir.split("/")[0],
+            env=env,
+            net=net,
+            skip_refresh=skip_refresh,
+            tmpfs_size=tmpfs_size,
+            chdir=Path(apkfoundry.MOUNTS["aportsdir"]) / startdir,
+            cgroup=cgroup,
+            **kwargs,
+        )
+    finally:
+        if sink:
+            sink.finish()
+    if sink:
+        _LOGGER.info("Full log (%d lines): %s", sink.lines, result.log)
+    if cgroup:
+        result.usage = cgroup.stats()
+        cgroup.remove()
+
+    if result.rc == 0:
+        result.manifest = _buildenv.read_manifest(cont)
+        if result.manifest is not None and result.log:
+            result.manifest["logs"].append(result.log)
 
-    if rc == 0:
         try:
             # Only remove TEMP files, not src/pkg
             _LOGGER.info("Removing package tmpfiles")
@@ -139,7 +186,7 @@ def run_task(cont, conf, startdir, script):
         except (FileNotFoundError, PermissionError):
             pass
 
-    return rc
+    return result
 
 def _interrupt(cont, startdir):
     prompt = """Interactive mode options:
@@ -166,7 +213,7 @@ def _interrupt(cont, startdir):
         return FailureAction.RECALCULATE
 
     if response in ("s", "n"):
-        env, _ = _run_env(cont, startdir)
+        env, _ = _buildenv.run_env(cont, startdir)
     else:
         env = {}
 
@@ -189,18 +236,107 @@ def _interrupt(cont, startdir):
 
     return None
 
-def run_graph(cont, conf, graph, opts):
-    initial = set(opts.startdirs)
-    done = {}
+def _version(meta):
+    if not meta or "pkgver" not in meta:
+        return None
+    return f"{meta['pkgver']}-r{meta['pkgrel']}"
+
+def _limit_type(opt):
+    def check(value):
+        try:
+            return _cgroup.LIMIT_CHECKS[opt](value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return check
 
+def _conf_enum(conf, key, enum_type, default):
     try:
-        on_failure = FailureAction[conf["build.on-failure"].upper()]
+        return enum_type[conf[key].upper()]
     except KeyError:
         _LOGGER.error(
-            "build.on-failure = %s is invalid; defaulting to STOP",
-            conf["build.on-failure"].upper(),
+            "%s = %s is invalid; defaulting to %s",
+            key, conf[key].upper(), default.name,
+        )
+        return default
+
+def _unbumped(graph, rdeps):
+    # apk does not upgrade to a package of the same version, so
+    # rebuilding these would only replace the packages in REPODEST
+    # behind the backs of the clients that already have them
+    unbumped = [
+        rdep for rdep, version in rdeps.items()
+        if version == _version(graph.metadata.get(rdep))
+    ]
+    for rdep in sorted(unbumped):
+        _LOGGER.error(
+            "%s: must be rebuilt for ABI changes, but its pkgrel has not"
+            " been bumped; skipping", rdep,
+        )
+        del rdeps[rdep]
+    return unbumped
+
+def _handle_failure(cont, graph, startdir, interactive, on_failure,
+                    initial, done):
+    """Decide what to do about the failed build of startdir, then update
+    the graph and the statuses in done accordingly."""
+    if interactive:
+        action = _interrupt(cont, startdir)
+        while action is None:
+            action = _interrupt(cont, startdir)
+    else:
+        action = on_failure
+
+    if action == FailureAction.RECALCULATE:
+        _log.section_start(
+            _LOGGER, "recalc-order", "Recalculating build order"
         )
-        on_failure = FailureAction.STOP
+
+        depfails = set(graph.all_downstreams(startdir))
+        for rdep in depfails:
+            graph.delete_node(rdep)
+        graph.delete_node(startdir)
+
+        depfails &= initial
+        for rdep in depfails:
+            _LOGGER.error("Depfail: %s", rdep)
+            done[rdep] = _buildlog.Status.DEPFAIL
+
+        _log.section_end(_LOGGER)
+
+    elif action == FailureAction.STOP:
+        _LOGGER.error("Stopping due to previous error")
+        cancels = initial - set(done.keys())
+        for rdep in cancels:
+            done[rdep] = _buildlog.Status.DEPFAIL
+        graph.reset_graph()
+
+    elif action == FailureAction.IGNORE:
+        _LOGGER.info("Ignoring error and continuing")
+
+def run_graph(cont, conf, graph, opts, fetcher=None):
+    initial = set(opts.startdirs)
+    done = {}
+    # startdir => BuildResult
+    results = {}
+    limits, jobs = _cgroup.resource_limits(opts)
+    lookahead = conf.getboolean("build.deps-lookahead")
+    defer_index = conf.getboolean("build.defer-index")
+    # startdir => REPO/ARCH directories whose index lacks its packages
+    unindexed = {}
+    abi_rebuild = conf.getboolean("build.abi-rebuild")
+    repodest = cont.cdir / "af/config/repodest"
+    # REPO/ARCH => packages in its index as of before this job
+    old_index = {}
+    # startdir => version of the packages it must replace for ABI reasons
+    forced = {}
+    unbumped = set()
+
+    on_failure = _conf_enum(
+        conf, "build.on-failure", FailureAction, FailureAction.STOP,
+    )
+    build_order = _conf_enum(
+        conf, "build.order", BuildOrder, BuildOrder.DEFAULT,
+    )
 
     while True:
         order = [
@@ -210,6 +346,14 @@ def run_graph(cont, conf, graph, opts):
         if not order:
             break
 
+        if build_order == BuildOrder.AFFINITY:
+            before = _count_installs(graph, order)
+            order = _affinity_order(graph, order)
+            _LOGGER.info(
+                "Dependency affinity saves an estimated %d of %d package installs",
+                before - _count_installs(graph, order), before,
+            )
+
         tot = len(order)
         cur = 0
 
@@ -224,60 +368,110 @@ def run_graph(cont, conf, graph, opts):
             cur += 1
             _log.section_start(
                 _LOGGER, "build_" + startdir.replace("/", "_"),
-                "(%d/%d) Start: %s", cur, tot, startdir
+                "(%d/%d) Start: %s", cur, tot, startdir,
+                trace={"startdir": startdir, "arch": opts.arch},
             )
 
-            rc = run_task(cont, conf, startdir, opts.build_script)
+            if fetcher:
+                fetcher.wait(order, cur - 1)
+
+            # Packages from this job can only be installed once they
+            # are in the index
+            needed = graph.predecessors(startdir)
+            if lookahead and cur < tot:
+                needed += graph.predecessors(order[cur])
+            if any(i in unindexed for i in needed):
+                update_index(cont, set().union(*unindexed.values()))
+                unindexed.clear()
+
+            indexdir = f"{startdir.split('/')[0]}/{opts.arch}"
+            if abi_rebuild:
+                _abi.old_index(repodest, old_index, indexdir)
+
+            # The world file must not be reset again after the
+            # dependencies have been installed
+            installed = lookahead \
+                and _buildenv.install_deps(cont, graph, order, cur - 1)
+            start = time.monotonic()
+            result = results[startdir] = run_task(
+                cont, conf, startdir, opts.build_script,
+                skip_refresh=installed, limits=limits, jobs=jobs,
+                meta=graph.metadata.get(startdir), force=startdir in forced,
+            )
+            rc = result.rc
+            _metrics.observe(
+                "build_duration_seconds", time.monotonic() - start,
+                status=str(
+                    _buildlog.Status.SUCCESS if rc == 0
+                    else _buildlog.Status.FAIL
+                ),
+            )
+            if rc == 0 and defer_index and result.manifest is not None:
+                unindexed[startdir] = _manifest.index_dirs(
+                    {startdir: result.manifest}
+                )
 
             if rc == 0:
+                rdeps = {}
+                if abi_rebuild:
+                    rdeps = _abi.rebuilds(
+                        repodest, graph, startdir, result.manifest,
+                        old_index, opts.arch,
+                    )
+                    rdeps = {
+                        rdep: version for rdep, version in rdeps.items()
+                        if rdep not in done
+                    }
+                    unbumped.update(_unbumped(graph, rdeps))
                 _log.section_end(
                     _LOGGER, "(%d/%d) Success: %s", cur, tot, startdir,
+                    trace={"rc": rc, "status": str(_buildlog.Status.SUCCESS)},
                 )
-                done[startdir] = Status.SUCCESS
+                done[startdir] = _buildlog.Status.SUCCESS
+                _buildlog.write_metrics(done)
+
+                new = set(_filter_list(
+                    conf, opts, sorted(set(rdeps) - initial),
+                ))
+                forced.update(
+                    (rdep, version) for rdep, version in rdeps.items()
+                    if rdep in initial or rdep in new
+                )
+                if new:
+                    _LOGGER.info(
+                        "Rebuilding reverse dependencies: %s",
+                        " ".join(sorted(new)),
+                    )
+                    initial |= new
+                    break
 
             else:
                 _log.section_end(
                     _LOGGER, "(%d/%d) Fail: %s", cur, tot, startdir,
+                    trace={"rc": rc, "status": str(_buildlog.Status.FAIL)},
                 )
-                done[startdir] = Status.FAIL
-
-                if opts.interactive:
-                    action = _interrupt(cont, startdir)
-                    while action is None:
-                        action = _interrupt(cont, startdir)
-                else:
-                    action = on_failure
-
-                if action == FailureAction.RECALCULATE:
-                    _log.section_start(
-                        _LOGGER, "recalc-order", "Recalculating build order"
-                    )
-
-                    depfails = set(graph.all_downstreams(startdir))
-                    for rdep in depfails:
-                        graph.delete_node(rdep)
-                    graph.delete_node(startdir)
-
-                    depfails &= initial
-                    for rdep in depfails:
-                        _LOGGER.error("Depfail: %s", rdep)
-                        done[rdep] = Status.DEPFAIL
-
-                    _log.section_end(_LOGGER)
-
-                elif action == FailureAction.STOP:
-                    _LOGGER.error("Stopping due to previous error")
-                    cancels = initial - set(done.keys())
-                    for rdep in cancels:
-                        done[rdep] = Status.DEPFAIL
-                    graph.reset_graph()
-
-                elif action == FailureAction.IGNORE:
-                    _LOGGER.info("Ignoring error and continuing")
-
+                done[startdir] = _buildlog.Status.FAIL
+                _handle_failure(
+                    cont, graph, startdir, opts.interactive, on_failure,
+                    initial, done,
+                )
+                _buildlog.write_metrics(done)
                 break
 
-    return _stats_builds(done)
+    indexed = True
+    if unindexed:
+        indexed = update_index(cont, set().union(*unindexed.values()))
+
+    _buildlog.write_stats(cont, done, results)
+    _buildlog.write_metrics(done)
+    rc = _buildlog.stats_builds(done, results) or int(not indexed)
+    if unbumped:
+        _LOGGER.error(
+            "Not rebuilt for ABI changes without a new version: %s",
+            " ".join(sorted(unbumped)),
+        )
+        rc = rc or 1
+    return rc
 
 def run_job(cont, conf, opts):
     _log.section_start(
@@ -289,42 +483,129 @@ def run_job(cont, conf, opts):
         return 1
     _log.section_end(_LOGGER)
 
-    return run_graph(cont, conf, graph, opts)
+    if opts.fetch_jobs <= 0:
+        return run_graph(cont, conf, graph, opts)
+
+    fetcher = apkfoundry.distfiles.Prefetcher(
+        cont, opts.startdirs, opts.fetch_jobs, opts.fetch_ahead,
+    )
+    try:
+        return run_graph(cont, conf, graph, opts, fetcher=fetcher)
+    finally:
+        fetcher.close()
+
+def _changed_blobs(gitdir, rev_range):
+    # Format: :OLDMODE NEWMODE OLDSHA NEWSHA STATUS\0PATH\0...
+    out = subprocess.check_output(
+        ("git", *gitdir, "diff-tree",
+         "-r", "-z", "--raw", "--no-commit-id", "--no-abbrev",
+         "--diff-filter", "dxu",
+         *rev_range.split(), "--", "*/*/APKBUILD"),
+        encoding="utf-8"
+    ).split("\0")
+
+    return [
+        (path, meta.split()[2], meta.split()[3])
+        for meta, path in zip(out[0::2], out[1::2])
+    ]
+
+def _read_blobs(gitdir, shas):
+    # Format: SHA TYPE SIZE\nCONTENTS\n...
+    out = subprocess.run(
+        ("git", *gitdir, "cat-file", "--batch", "--buffer"),
+        input="".join(sha + "\n" for sha in shas).encode("utf-8"),
+        stdout=subprocess.PIPE, check=True,
+    ).stdout
+
+    blobs = {}
+    offset = 0
+    for sha in shas:
+        end = out.index(b"\n", offset)
+        header = out[offset:end].split()
+        if header[1] == b"missing":
+            blobs[sha] = b""
+            offset = end + 1
+            continue
+        size = int(header[2])
+        blobs[sha] = out[end + 1:end + 1 + size]
+        offset = end + 1 + size + 1
+
+    return blobs
+
+def _versions(blob):
+    # Much faster than splitting the whole APKBUILD into lines
+    versions = []
+    blob = b"\n" + blob
+    for key in (b"\npkgver=", b"\npkgrel="):
+        i = blob.find(key)
+        while i >= 0:
+            end = blob.find(b"\n", i + 1)
+            line = blob[i + 1:end] if end >= 0 else blob[i + 1:]
+            versions.append(
+                line.strip().replace(b"\"", b"").replace(b"'", b"")
+            )
+            i = blob.find(key, i + 1)
+    return versions
 
 def changed_pkgs(conf, opts):
     gitdir = ["-C", str(opts.aportsdir)] \
         if opts.aportsdir else []
-    pickaxe = ["-G", "^pkg(ver|rel)="] \
-        if conf.getboolean("build.only-changed-versions") else []
 
-    pkgs = subprocess.check_output(
-        ("git", *gitdir, "diff-tree",
-         "-r", "--name-only", "--diff-filter", "dxu", *pickaxe,
-         *opts.rev_range.split(), "--", "*/*/APKBUILD"),
-        encoding="utf-8"
-    ).splitlines()
-    return [i.replace("/APKBUILD", "") for i in pkgs]
+    changes = _changed_blobs(gitdir, opts.rev_range)
+    if conf.getboolean("build.only-changed-versions"):
+        # The old blob of new APKBUILDs is all zeros
+        shas = {
+            sha for _, old, new in changes for sha in (old, new)
+            if sha.strip("0")
+        }
+        blobs = _read_blobs(gitdir, sorted(shas))
+        # New APKBUILDs are always built
+        changes = [
+            (path, old, new) for path, old, new in changes
+            if not old.strip("0")
+            or _versions(blobs[old]) != _versions(blobs[new])
+        ]
 
-def resignapk(repodest, privkey, pubkey, now):
-    _log.section_start(_LOGGER, "resignapk", "Re-signing APKs...")
-    apks = [
+    return [path.replace("/APKBUILD", "") for path, _, _ in changes]
+
+def _new_apks(repodest, manifest, now):
+    if manifest and manifest["complete"]:
+        return [
+            repodest / package["path"]
+            for build in manifest["builds"].values()
+            for package in build["packages"]
+        ]
+
+    _LOGGER.info("No complete package manifest; searching REPODEST")
+    return [
         i for i in repodest.glob("**/*.apk")
         if i.stat().st_mtime > now
     ]
+
+def resignapk(cdir, privkey, pubkey, now):
+    """Re-sign the packages built in the container at cdir since now and
+    their indexes. Returns the number of files that could not be
+    re-signed."""
+    _log.section_start(_LOGGER, "resignapk", "Re-signing APKs...")
+    repodest = cdir / "af/config/repodest"
+    manifest = _manifest.load(cdir, since=now)
+    apks = _new_apks(repodest, manifest, now)
     if not apks:
         _log.section_end(_LOGGER, "No new .apk files found!")
-        return
+        return 0
 
     _LOGGER.info("Found %d new .apk files", len(apks))
-    apks += set(repodest.glob("**/APKINDEX.tar.gz"))
-    _util.check_call((
-        "fakeroot", "--",
-        "resignapk", "-iq",
-        "-p", pubkey,
-        "-k", privkey,
-        *apks,
-    ))
+    indexes = {
+        i.parent / "APKINDEX.tar.gz" for i in apks
+        if (i.parent / "APKINDEX.tar.gz").is_file()
+    }
+    failed = _sign.resign([*apks, *indexes], privkey, pubkey)
+    if failed:
+        _LOGGER.error("Failed to re-sign %d files", failed)
+    if manifest:
+        _manifest.refresh(cdir, manifest)
     _log.section_end(_LOGGER)
+    return failed
 
 def _cleanup(rc, cont, delete):
     if hasattr(cont, "destroy"):
@@ -432,6 +713,27 @@ def _buildrepo_args(args):
         help="external source file cache directory (default: none)",
     )
     cont.add_argument("-s", "--srcdest", help=argparse.SUPPRESS)
+    cont.add_argument(
+        "--cpus", type=_limit_type("cpus"),
+        help="""limit each build to this many CPUs worth of time, e.g.
+        2.5 (default: site configuration container.cpus, otherwise
+        none)""",
+    )
+    cont.add_argument(
+        "--cpuset", type=_limit_type("cpuset"),
+        help="""run builds only on these CPUs, e.g. 0-3,8 (default: site
+        configuration container.cpuset, otherwise none)""",
+    )
+    cont.add_argument(
+        "--io-weight", metavar="WEIGHT", type=_limit_type("io_weight"),
+        help="""I/O weight of each build from 1 to 10000 (default: site
+        configuration container.io-weight, otherwise none)""",
+    )
+    cont.add_argument(
+        "--memory-max", metavar="SIZE", type=_limit_type("memory_max"),
+        help="""limit the memory usage of each build, e.g. 8G (default:
+        site configuration container.memory-max, otherwise none)""",
+    )
     cont.add_argument(
         "--directory", metavar="CDIR",
         help=f"""use CDIR as the container root (default: temporary
@@ -476,10 +778,41 @@ def _buildrepo_args(args):
         "--dry-run", action="store_true",
         help="only show what would be built, then exit",
     )
+    opts.add_argument(
+        "--fetch-ahead", type=int, default=5, metavar="K",
+        help="""with --fetch-jobs, download the sources of the next K
+        packages in the build order in the background (default: 5)""",
+    )
+    opts.add_argument(
+        "--fetch-jobs", type=int, default=0, metavar="N",
+        help="""download sources on the host, outside of the
+        container, N at a time. By default fetching is left to each
+        build (default: 0)""",
+    )
     opts.add_argument(
         "-i", "--interactive", action="store_true",
         help="interactively stop when a package fails to build",
     )
+    opts.add_argument(
+        "--timing", action="store_true",
+        help="""record how long each phase of starting containers takes
+        and show a summary at the end (default: only if $AF_TIMING is
+        set)""",
+    )
+    opts.add_argument(
+        "--trace", metavar="FILE",
+        help="""record the start and end of each section (including
+        each build) to FILE in Chrome Trace Event format, and export
+        it as $AF_TRACE to the programs started by af-buildrepo
+        (default: the value of $AF_TRACE, if set)""",
+    )
+    opts.add_argument(
+        "--metrics", metavar="FILE",
+        help="""write build, container, and af-sudo metrics to FILE in
+        the Prometheus text format during and at the end of the job
+        (default: textfile in the [metrics] section of the site
+        configuration, if set)""",
+    )
     opts.add_argument(
         "-k", "--key",
         help="re-sign APKs with FILE outside of container",
@@ -564,6 +897,17 @@ def _buildrepo_bootstrap(opts, cdir):
 
 def buildrepo(args):
     opts = _buildrepo_args(args)
+    if opts.trace:
+        _log.enable_trace(opts.trace)
+    if opts.metrics is None:
+        opts.metrics = apkfoundry.site_conf("metrics")["textfile"]
+    if opts.metrics:
+        try:
+            expire = int(apkfoundry.site_conf("metrics")["expire"])
+        except ValueError as e:
+            _LOGGER.error("metrics.expire: %s", e)
+            return _cleanup(1, None, opts.delete)
+        _metrics.enable(opts.metrics, expire=expire if expire > 0 else None)
 
     if opts.dry_run:
         opts.delete = "always"
@@ -578,6 +922,9 @@ def buildrepo(args):
         )
         return _cleanup(1, None, opts.delete)
 
+    if not _cgroup.check_limits(opts):
+        return _cleanup(1, None, opts.delete)
+
     if opts.aportsdir:
         opts.aportsdir = Path(opts.aportsdir)
         if not opts.branch:
@@ -633,14 +980,17 @@ def buildrepo(args):
         return _cleanup(1, cont, opts.delete)
 
     if opts.key:
-        repodest = cdir / "af/config/repodest"
         now = time.time()
 
+    if opts.timing:
+        _timing.enable()
     rc = run_job(cont, conf, opts)
+    _timing.report()
 
     if opts.key:
         if opts.pubkey is None:
             opts.pubkey = Path(opts.key).name + ".pub"
-        resignapk(repodest, opts.key, opts.pubkey, now)
+        if resignapk(cdir, opts.key, opts.pubkey, now):
+            rc = max(rc, 1)
 
     return _cleanup(rc, cont, opts.delete)
@@ -2,25 +2,35 @@
 # Copyright (c) 2019-2020 Max Rees
 # See LICENSE for more information.
 import argparse   # ArgumentParser, SUPPRESS
+import concurrent.futures # ThreadPoolExecutor
+import contextlib # suppress
+import errno      # EXDEV
 import json       # load
 import logging    # getLogger
 import os         # close, environ, fdopen, getgid, getuid, listdir, pipe, write
-                  # isatty, tcgetpgrp, tcsetpgrp
+                  # isatty, nice, rename, tcgetpgrp, tcsetpgrp
 import select     # select
 import shutil     # chown, copy2, copytree, rmtree
 import signal     # SIG_IGN, signal, SIGTTOU
-import subprocess # call, Popen
+import subprocess # call, DEVNULL, Popen
 import sys        # stdin
+import tempfile   # mkdtemp
+import time       # monotonic
 from pathlib import Path
 
 import apkfoundry         # BWRAP, DEFAULT_ARCH, HOME, LIBEXECDIR, MOUNTS,
-                          # ROOTFS_CACHE, SYSCONFDIR, proj_conf, site_conf
+                          # ROOTFS_CACHE, SYSCONFDIR, TRASHDIR, proj_conf,
+                          # site_conf
+import apkfoundry._metrics as _metrics
 import apkfoundry._rootfs as _rootfs
 import apkfoundry._sudo as _sudo
+import apkfoundry._timing as _timing
 import apkfoundry._util as _util
 
 _LOGGER = logging.getLogger(__name__)
 
+# Prefix of trash directories that are still being moved into place
+_TRASH_PENDING = ".pending-"
 _KEEP_ENV = (
     "TERM",
 )
@@ -54,7 +64,8 @@ def _idmap(cmd, pid, ent_id):
         raise ValueError("map must have 3 entries per line")
 
     args = [str(i) for i in args]
-    return subprocess.call((cmd, str(pid), *args))
+    with _timing.phase("bwrap." + cmd):
+        return subprocess.call((cmd, str(pid), *args))
 
 def _userns_init(pid, uid, gid):
     retcodes = []
@@ -132,7 +143,8 @@ class Container:
             self._arch = self._read_info("etc/apk/arch")
         return self._arch
 
-    def _bwrap(self, args, *, net=False, su=False, setsid=True, **kwargs):
+    def _bwrap(self, args, *, net=False, su=False, setsid=True, wait=True,
+               cgroup=None, **kwargs):
         if "env" not in kwargs:
             kwargs["env"] = {}
         kwargs["env"].update({
@@ -193,18 +205,46 @@ class Container:
                 "--cap-add", "CAP_SETGID",
             ])
 
-        proc = subprocess.Popen(args_pre + args, **kwargs)
+        start = time.monotonic()
+        with _timing.phase("bwrap.popen"):
+            proc = subprocess.Popen(args_pre + args, **kwargs)
         os.close(pipe_r)
         os.close(info_w)
-        select.select([info_r], [], [])
-        info = json.load(os.fdopen(info_r))
+        with _timing.phase("bwrap.info_fd"):
+            select.select([info_r], [], [])
+            info = json.load(os.fdopen(info_r))
+        if cgroup:
+            # The child is still blocked, so everything it starts will
+            # be accounted for
+            try:
+                cgroup.attach(proc.pid, info["child-pid"])
+            except OSError as e:
+                if not cgroup.limits:
+                    _LOGGER.warning("Could not attach to cgroup: %s", e)
+                else:
+                    # Don't let it run without its resource limits
+                    _LOGGER.error("Could not attach to cgroup: %s", e)
+                    proc.kill()
+                    os.close(pipe_w)
+                    proc.communicate()
+                    return (1, proc)
         retcodes = _userns_init(
             info["child-pid"], self._uid, self._gid,
         )
         os.write(pipe_w, b"\n")
         os.close(pipe_w)
+        _metrics.observe("container_spawn_seconds", time.monotonic() - start)
 
-        proc.stdout, proc.stderr = proc.communicate()
+        if not wait:
+            # The caller is responsible for waiting on the container
+            if any(retcodes):
+                _LOGGER.debug("container failed with status %r!", retcodes)
+                proc.kill()
+                proc.wait()
+            return (max(abs(i) for i in retcodes), proc)
+
+        with _timing.phase("bwrap.communicate"):
+            proc.stdout, proc.stderr = proc.communicate()
 
         if pgrp:
             handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
@@ -217,7 +257,9 @@ class Container:
             _LOGGER.debug("container failed with status %r!", retcodes)
         return (max(abs(i) for i in retcodes), proc)
 
-    def _resolv_mounts(self):
+    def resolv_mounts(self):
+        """Return the host directories of the container's mounts (see
+        apkfoundry.MOUNTS) by name."""
         mounts = apkfoundry.MOUNTS.copy()
         for mount in mounts:
             mounts[mount] = self.cdir / "af/config" / mount
@@ -254,6 +296,7 @@ class Container:
             "AF_LIBEXEC": "/af/libexec",
         })
 
+    @_timing.timed("run_external")
     def run_external(self, cmd, skip_mounts=False, **kwargs):
         args = [
             "--ro-bind", "/", "/",
@@ -271,7 +314,8 @@ class Container:
         ]
 
         if not skip_mounts:
-            mounts = self._resolv_mounts()
+            with _timing.phase("resolv_mounts"):
+                mounts = self.resolv_mounts()
             args += [
                 "--bind", mounts["aportsdir"],
                 "/tmp/af/cdir" + apkfoundry.MOUNTS["aportsdir"],
@@ -320,7 +364,14 @@ class Container:
         )
         return rc
 
-    def destroy(self):
+    def destroy(self, *, wait=False):
+        if not wait:
+            trash = _move_to_trash(self.cdir)
+            if trash:
+                _LOGGER.debug("Moved container to %s", trash)
+                _spawn_reaper()
+                return 0
+
         children = os.listdir(self.cdir)
         if children:
             rc, _ = self.run_external(
@@ -348,6 +399,7 @@ class Container:
         )
         return rc
 
+    @_timing.timed("run")
     def run(self,
             cmd,
             *,
@@ -357,6 +409,7 @@ class Container:
             skip_mounts=False,
             skip_refresh=False,
             skip_sudo=False,
+            tmpfs_size=None,
 
             net=False,
             setsid=True,
@@ -382,14 +435,27 @@ class Container:
         ]
 
         if not skip_mounts:
-            mounts = self._resolv_mounts()
+            with _timing.phase("resolv_mounts"):
+                mounts = self.resolv_mounts()
+            if tmpfs_size:
+                # Contents are discarded when the container exits
+                scratch = [
+                    "--perms", "01777", "--size", str(tmpfs_size),
+                    "--tmpfs", "/tmp",
+                    "--perms", "01777", "--size", str(tmpfs_size),
+                    "--tmpfs", apkfoundry.MOUNTS["builddir"],
+                ]
+            else:
+                scratch = [
+                    "--bind", self.cdir / "tmp", "/tmp",
+                    "--bind", mounts["builddir"], apkfoundry.MOUNTS["builddir"],
+                ]
             args += [
-                "--bind", self.cdir / "tmp", "/tmp",
+                *scratch,
                 "--bind", self.cdir / "var/tmp", "/var/tmp",
                 aports_bind, mounts["aportsdir"], apkfoundry.MOUNTS["aportsdir"],
                 "--bind", mounts["repodest"], apkfoundry.MOUNTS["repodest"],
                 "--bind", mounts["srcdest"], apkfoundry.MOUNTS["srcdest"],
-                "--bind", mounts["builddir"], apkfoundry.MOUNTS["builddir"],
                 "--chdir", chdir or apkfoundry.MOUNTS["aportsdir"],
             ]
             if (self.cdir / "af/config/cache").exists():
@@ -399,8 +465,11 @@ class Container:
             if repo:
                 self.repo = repo
 
-        if not skip_refresh and self.refresh():
-            return 1, None
+        if not skip_refresh:
+            _metrics.inc("container_refreshes_total")
+            with _timing.phase("run.refresh"):
+                if self.refresh():
+                    return 1, None
 
         if self.sudo_conn and not skip_sudo:
             if "pass_fds" not in kwargs:
@@ -438,16 +507,99 @@ class Container:
             **kwargs,
         )
 
-def _make_infodir(conf, opts):
-    af_info = opts.cdir / "af/config/host"
-    af_info.mkdir(parents=True)
-    af_info = af_info.parent
+def _move_to_trash(cdir):
+    apkfoundry.TRASHDIR.mkdir(parents=True, exist_ok=True)
+    # rename(2) atomically replaces an empty directory, so this gives
+    # us a unique name without racing against other destroyers. The
+    # placeholder is ignored by reapers until the container is in place
+    pending = Path(tempfile.mkdtemp(
+        dir=apkfoundry.TRASHDIR, prefix=_TRASH_PENDING + cdir.name + ".",
+    ))
+    trash = pending.with_name(pending.name[len(_TRASH_PENDING):])
+
+    try:
+        os.rename(cdir, pending)
+    except OSError as e:
+        pending.rmdir()
+        if e.errno != errno.EXDEV:
+            raise
+        _LOGGER.debug("%s is not on the same filesystem as %s", cdir, trash)
+        return None
 
-    (af_info / "branch").write_text(opts.branch.strip())
+    os.rename(pending, trash)
+    return trash
+
+def _spawn_reaper():
+    try:
+        subprocess.Popen(
+            ("af-rmchroot", "--reap"),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        _LOGGER.warning("Could not start af-rmchroot --reap: %s", e)
+
+def _reap_one(trash):
+    lock = trash.with_name(trash.name + ".lock")
+    try:
+        with _util.lock_file(lock, blocking=False):
+            rc = 0
+            # Another reaper may have finished it in the meantime
+            if trash.is_dir():
+                _LOGGER.debug("Reaping %s", trash.name)
+                rc = Container(trash, sudo=False).destroy(wait=True)
+            if rc == 0:
+                with contextlib.suppress(FileNotFoundError):
+                    lock.unlink()
+    except BlockingIOError:
+        # Another reaper is already on it
+        return 0
+
+    return rc
+
+def reap_trash(jobs=None):
+    # Be a good neighbor to the builds running on this host
+    os.nice(19)
+    try:
+        subprocess.call(
+            ("ionice", "-c", "3", "-p", str(os.getpid())),
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError as e:
+        _LOGGER.debug("Could not lower I/O priority: %s", e)
+
+    rc = 0
+    seen = set()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        # Keep going until no new containers have been trashed
+        while True:
+            try:
+                trash = [
+                    i for i in apkfoundry.TRASHDIR.iterdir()
+                    if i.is_dir() and i not in seen
+                    and not i.name.startswith(_TRASH_PENDING)
+                ]
+            except FileNotFoundError:
+                break
+            if not trash:
+                break
+
+            seen.update(trash)
+            rc = max(rc, *pool.map(_reap_one, trash))
+
+    return rc
+
+def _link_mounts(conf, opts):
+    af_info = opts.cdir / "af/config"
     (af_info / "repo").write_text(conf["repo.default"].strip())
 
+    setarch_f = af_info / "setarch"
     if opts.setarch:
-        (opts.cdir / "af/config/setarch").write_text(opts.setarch.strip())
+        setarch_f.write_text(opts.setarch.strip())
+    elif setarch_f.exists():
+        setarch_f.unlink()
 
     mounts = {
         "aportsdir": opts.aportsdir, # this make act weird since
@@ -462,20 +614,52 @@ def _make_infodir(conf, opts):
         if not mounts[mount]:
             continue
 
-        (opts.cdir / "af/config" / mount).symlink_to(mounts[mount])
+        _util.symlink(af_info / mount, mounts[mount], opts.cdir)
 
     for mount in apkfoundry.MOUNTS:
         if mounts.get(mount):
             continue
 
-        (opts.cdir / "af/config" / mount).symlink_to(
-            opts.cdir / apkfoundry.MOUNTS[mount].lstrip("/")
+        _util.symlink(
+            af_info / mount,
+            opts.cdir / apkfoundry.MOUNTS[mount].lstrip("/"),
+            opts.cdir,
         )
 
+    if opts.cache_apk:
+        _util.symlink(af_info / "cache", opts.cache_apk, opts.cdir)
+    elif (af_info / "cache").is_symlink():
+        (af_info / "cache").unlink()
+
+def _make_infodir(conf, opts):
+    af_info = opts.cdir / "af/config/host"
+    af_info.mkdir(parents=True)
+    af_info = af_info.parent
+
+    (af_info / "branch").write_text(opts.branch.strip())
+
+    _link_mounts(conf, opts)
+
     (opts.cdir / "af/libexec").mkdir()
 
-    if opts.cache_apk:
-        (opts.cdir / "af/config/cache").symlink_to(opts.cache_apk)
+def _cont_reuse(conf, opts):
+    cont = Container(opts.cdir)
+    if cont.branch != opts.branch.strip() or cont.arch != opts.arch:
+        _LOGGER.error(
+            "existing container is for %s/%s, not %s/%s",
+            cont.branch, cont.arch, opts.branch.strip(), opts.arch,
+        )
+        return None
+
+    _LOGGER.info("Reusing existing container")
+    _link_mounts(conf, opts)
+
+    if not opts.no_pubkey_copy:
+        repodest = cont.resolv_mounts()["repodest"]
+        for key in (opts.cdir / _ABUILD_USERDIR).glob("*.pub"):
+            shutil.copy2(key, repodest)
+
+    return cont
 
 def _cont_make_args(args):
     opts = argparse.ArgumentParser(
@@ -559,6 +743,10 @@ def cont_make(args):
     branchdir = _util.get_branchdir(opts.aportsdir, opts.branch)
     conf = apkfoundry.proj_conf(opts.aportsdir, opts.branch)
 
+    # Already bootstrapped, e.g. claimed from a container pool
+    if (opts.cdir / "af/config/host").is_dir():
+        return _cont_reuse(conf, opts)
+
     (opts.cdir / "af").mkdir(parents=True, exist_ok=True)
     opts.cdir.chmod(0o770)
 
@@ -9,6 +9,8 @@ import logging     # getLogger
 import subprocess  # PIPE, run
 
 _LOGGER = logging.getLogger(__name__)
+# af-deps metadata that consists of multiple words
+_METADATA_LISTS = ("arch", "options", "source", "subpackages")
 
 class DAGValidationError(Exception):
     def __init__(self, cycle):
@@ -22,6 +24,14 @@ class Digraph:
 
            Construct a new directed graph with no nodes or edges.
         """
+        # Filled in by generate_graph for installing build dependencies
+        # ahead of time: startdir => names of its dependencies, and
+        # package name => startdir that provides it
+        self.depnames = {}
+        self.origins = {}
+        # startdir => the APKBUILD variables reported by af-deps, which
+        # saves build.py from reading the APKBUILDs again
+        self.metadata = {}
         self.reset_graph()
 
     def reset_graph(self):
@@ -246,6 +256,7 @@ def generate_graph(conf, *, use_ignore=True, skip_check=False, cont=None):
 
     origins = {}
     deps = collections.defaultdict(list)
+    metadata = collections.defaultdict(dict)
     for line in proc.stdout.split("\n"):
         line = line.strip().split(maxsplit=2)
         if not line:
@@ -268,6 +279,15 @@ def generate_graph(conf, *, use_ignore=True, skip_check=False, cont=None):
         # Masked: startdir $1 is masked by $arch/$options
         elif line[0] == "m":
             _LOGGER.warning("masked: %s", line[1])
+            metadata[line[1]]["masked"] = True
+        # Metadata: startdir $1 has variable $2 set to $3...
+        elif line[0] == "i":
+            startdir = line[1]
+            key, _, value = line[2].partition(" ")
+            if key in _METADATA_LISTS:
+                metadata[startdir][key] = value.split()
+            else:
+                metadata[startdir][key] = value.strip()
         else:
             _LOGGER.error("invalid af-deps output: %r", line)
             return None
@@ -294,4 +314,9 @@ def generate_graph(conf, *, use_ignore=True, skip_check=False, cont=None):
     for dep in sorted(missing):
         _LOGGER.warning("unknown dependency: %s", dep)
 
+    graph.depnames.update(deps)
+    graph.origins.update(deps_map)
+    graph.origins.update(origins)
+    graph.metadata.update(metadata)
+
     return graph
@@ -0,0 +1,185 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import collections        # Counter, defaultdict
+import concurrent.futures # ThreadPoolExecutor
+import errno              # EXDEV
+import http.client        # HTTPException
+import logging            # getLogger
+import os                 # getpid, link, lstat, replace, unlink
+import re                 # compile
+import shutil             # copy2
+import subprocess         # PIPE
+import urllib.parse       # urlparse
+
+import apkfoundry # DISTFILE_STORE
+import apkfoundry._log as _log
+import apkfoundry._util as _util
+
+_LOGGER = logging.getLogger(__name__)
+
+# Distfiles are stored as XX/SHA512 so that identical sources are only
+# downloaded and verified once, no matter which project or branch
+# needs them.
+_FETCH_TRIES = 3
+_SCHEMES = ("http", "https", "ftp")
+_SHA512 = re.compile(r"^[0-9a-f]{128}$")
+
+def _store_path(sha512):
+    return apkfoundry.DISTFILE_STORE / sha512[:2] / sha512
+
+def _link(src, dest):
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}")
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+def _download(url, blob, sha512):
+    part = blob.with_name(blob.name + ".part")
+
+    for attempt in range(1, _FETCH_TRIES + 1):
+        try:
+            new = _util.download_chunks(url, part, "sha512")
+            break
+        except (OSError, http.client.HTTPException) as e:
+            _LOGGER.warning(
+                "%s: attempt %d failed: %s", url, attempt, e,
+            )
+    else:
+        return False
+
+    if new.hexdigest() != sha512:
+        _LOGGER.error("%s: sha512 does NOT match", url)
+        part.unlink()
+        return False
+
+    os.replace(part, blob)
+    return True
+
+def _check_source(name, sha512, url):
+    # These come from the APKBUILD, but are used outside of the
+    # container
+    if "/" in name or name in ("", ".", ".."):
+        return f"invalid file name {name!r}"
+    if not _SHA512.match(sha512):
+        return f"invalid sha512 {sha512!r}"
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme not in _SCHEMES:
+        return f"unsupported URL scheme {scheme!r}"
+    return None
+
+def _fetch_one(srcdest, name, sha512, url):
+    error = _check_source(name, sha512, url)
+    if error:
+        _LOGGER.warning("%s: %s", url, error)
+        return "failed"
+
+    dest = srcdest / name
+    blob = _store_path(sha512)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+
+    if dest.exists():
+        if os.lstat(dest).st_nlink > 1:
+            return "cached"
+        # Left over from a previous build; share it if it's good
+        if not blob.exists() \
+                and _util.hash_file(dest, "sha512").hexdigest() == sha512:
+            _link(dest, blob)
+        return "cached"
+
+    with _util.lock_file(blob.with_name(blob.name + ".lock")):
+        if blob.exists():
+            status = "shared"
+        elif _download(url, blob, sha512):
+            status = "downloaded"
+        else:
+            return "failed"
+
+    _link(blob, dest)
+    return status
+
+def _list_sources(cont, startdirs):
+    rc, proc = cont.run(
+        ["/af/libexec/af-sources", *startdirs],
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+        skip_refresh=True, skip_sudo=True,
+    )
+    if rc != 0:
+        _LOGGER.error("af-sources failed with status %d", rc)
+        return None
+
+    sources = collections.defaultdict(list)
+    for line in proc.stdout.splitlines():
+        line = line.split(maxsplit=3)
+        if len(line) != 4:
+            _LOGGER.error("invalid af-sources output: %r", line)
+            return None
+        sources[line[0]].append(line[1:])
+
+    return sources
+
+class Prefetcher:
+    """Fetch the sources of upcoming builds in the background. Before
+    each build, wait() queues the sources of the next ahead packages in
+    the build order and then waits for those of the current one, so
+    downloads overlap with the builds instead of holding them up."""
+
+    def __init__(self, cont, startdirs, jobs, ahead):
+        self.ahead = ahead
+        self.results = collections.Counter()
+        self._futures = {}
+        self._srcdest = (cont.cdir / "af/config/srcdest").resolve()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+        _log.section_start(_LOGGER, "prefetch", "Listing sources...")
+        self._sources = _list_sources(cont, startdirs) or {}
+        _log.section_end(
+            _LOGGER, "Found %d sources",
+            sum(len(i) for i in self._sources.values()),
+        )
+
+    def _submit(self, startdir):
+        if startdir in self._futures:
+            return
+        self._futures[startdir] = [
+            (self._pool.submit(_fetch_one, self._srcdest, *source), source)
+            for source in self._sources.get(startdir, ())
+        ]
+
+    def wait(self, order, cur):
+        for startdir in order[cur:cur + self.ahead + 1]:
+            self._submit(startdir)
+
+        futures = self._futures[order[cur]]
+        if not all(future.done() for future, _ in futures):
+            _LOGGER.info("Waiting for sources...")
+
+        for future, (name, _, url) in futures:
+            try:
+                status = future.result()
+            except Exception as e: # pylint: disable=broad-except
+                # Prefetching is only an optimization; it must never
+                # stop the job
+                _LOGGER.error("%s: %s", name, e)
+                status = "failed"
+            if status == "failed":
+                # abuild will try again and report the error itself
+                _LOGGER.warning("Could not fetch %s", url)
+            self.results[status] += 1
+
+    def close(self):
+        # Nothing waits for builds that won't happen anymore
+        for futures in self._futures.values():
+            for future, _ in futures:
+                future.cancel()
+        self._pool.shutdown()
+
+        if self.results:
+            _LOGGER.info("Sources: %s", ", ".join(
+                f"{n} {status}" for status, n in sorted(self.results.items())
+            ))
@@ -0,0 +1,260 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+import argparse   # ArgumentParser
+import hashlib    # sha256
+import logging    # getLogger
+import os         # rename
+import shutil     # copytree, ignore_patterns, rmtree
+import subprocess # DEVNULL, Popen
+import tempfile   # mkdtemp
+from pathlib import Path
+
+import apkfoundry           # DEFAULT_ARCH, MOUNTS, POOLDIR, site_conf
+import apkfoundry.container # Container, cont_make
+import apkfoundry._util as _util
+
+_LOGGER = logging.getLogger(__name__)
+
+_CONFIG_NAME = ".apkfoundry"
+_DIGEST_FILE = "af/pool-config"
+
+def pool_dir(project, branch, arch):
+    # gl-config passes AF_ARCH as is, while af-pool defaults it
+    arch = arch or apkfoundry.DEFAULT_ARCH
+    return apkfoundry.POOLDIR / f"{project}.{branch.replace('/', '-')}.{arch}"
+
+def pool_size():
+    return apkfoundry.site_conf("container").getint("pool-size")
+
+def claim(pooldir, dest):
+    # dest must be an empty directory on the same filesystem; rename(2)
+    # replaces it atomically, so each ready container is handed to
+    # exactly one job
+    if not pooldir.is_dir():
+        return False
+
+    for cdir in sorted(pooldir.glob("*.af")):
+        try:
+            os.rename(cdir, dest)
+        except FileNotFoundError:
+            # Claimed by someone else first
+            continue
+        except OSError as e:
+            # e.g. dest is on another filesystem or not empty; the job
+            # bootstraps its container from scratch instead
+            _LOGGER.warning("Could not claim %s: %s", cdir.name, e)
+            return False
+        _LOGGER.info("Claimed ready container %s", cdir.name)
+        return True
+
+    return False
+
+def check_claimed(cdir, aportsdir):
+    """If cdir was claimed from a pool but bootstrapped with a different
+    configuration than the one in aportsdir, discard everything except
+    the checkout so that it is bootstrapped from scratch. Return False
+    if the container was discarded."""
+    try:
+        digest = (cdir / _DIGEST_FILE).read_text().strip()
+    except FileNotFoundError:
+        # Not from a pool
+        return True
+    if digest == _config_digest(Path(aportsdir) / _CONFIG_NAME):
+        return True
+
+    keep = (
+        cdir / "af",
+        cdir / apkfoundry.MOUNTS["aportsdir"].lstrip("/"),
+        cdir / "af/scripts",
+    )
+    stale = Path(tempfile.mkdtemp(dir=cdir.parent, suffix=".af"))
+    (stale / "af").mkdir()
+    for path in [*cdir.iterdir(), *(cdir / "af").iterdir()]:
+        if path not in keep:
+            os.rename(path, stale / path.relative_to(cdir))
+    apkfoundry.container.Container(stale, sudo=False).destroy()
+    return False
+
+def refill_async(project, branch, arch, aportsdir, **kwargs):
+    args = [
+        "af-pool",
+        "--arch", arch,
+        "--branch", branch,
+    ]
+    for opt in ("cache_apk", "cache_src", "setarch"):
+        if kwargs.get(opt):
+            args += ["--" + opt.replace("_", "-"), kwargs[opt]]
+    args += ["--", project, aportsdir]
+
+    try:
+        subprocess.Popen(
+            [str(i) for i in args],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        _LOGGER.warning("Could not start af-pool: %s", e)
+
+def _config_digest(confdir):
+    digest = hashlib.sha256()
+    for path in sorted(confdir.rglob("*")):
+        # Snapshots are taken without .git, see _snapshot_config
+        if path.is_dir() or ".git" in path.relative_to(confdir).parts:
+            continue
+        digest.update(str(path.relative_to(confdir)).encode("utf-8") + b"\0")
+        if path.is_symlink():
+            digest.update(os.readlink(path).encode("utf-8"))
+        else:
+            digest.update(path.read_bytes())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _snapshot_config(pooldir, aportsdir):
+    # Only the configuration directory is needed for bootstrapping, and
+    # it must outlive the job that requested the refill
+    new = Path(tempfile.mkdtemp(dir=pooldir, prefix=".aports."))
+    shutil.copytree(
+        Path(aportsdir) / _CONFIG_NAME, new / _CONFIG_NAME,
+        symlinks=True, ignore=shutil.ignore_patterns(".git"),
+    )
+    new.chmod(0o755)
+
+    snapshot = pooldir / ".aports"
+    if snapshot.exists():
+        old = Path(tempfile.mkdtemp(dir=pooldir, prefix=".aports."))
+        os.rename(snapshot, old)
+        shutil.rmtree(old)
+    os.rename(new, snapshot)
+
+    return snapshot, _config_digest(snapshot / _CONFIG_NAME)
+
+def _purge_stale(pooldir, digest):
+    for cdir in pooldir.glob("*.af"):
+        try:
+            if (cdir / _DIGEST_FILE).read_text().strip() == digest:
+                continue
+            _LOGGER.info("Discarding outdated container %s", cdir.name)
+            apkfoundry.container.Container(cdir, sudo=False).destroy()
+        except FileNotFoundError:
+            # Claimed in the meantime
+            continue
+
+def _purge_building(pooldir):
+    # Left behind by interrupted refills. Only called with the pool
+    # lock held, so nothing else is building
+    building = pooldir / ".building"
+    if not building.is_dir():
+        return
+    for cdir in building.iterdir():
+        _LOGGER.info("Discarding unfinished container %s", cdir.name)
+        apkfoundry.container.Container(cdir, sudo=False).destroy()
+
+def _fill_one(pooldir, snapshot, digest, opts):
+    building = pooldir / ".building"
+    building.mkdir(exist_ok=True)
+    cdir = Path(tempfile.mkdtemp(dir=building, suffix=".af"))
+
+    args = [
+        "--arch", opts.arch,
+        "--branch", opts.branch,
+    ]
+    if opts.cache_apk:
+        args += ["--cache-apk", opts.cache_apk]
+    if opts.cache_src:
+        args += ["--cache-src", opts.cache_src]
+    if opts.setarch:
+        args += ["--setarch", opts.setarch]
+    args += ["--", str(cdir), str(snapshot)]
+
+    cont = apkfoundry.container.cont_make(args)
+    if not cont:
+        _LOGGER.error("Failed to bootstrap pool container")
+        apkfoundry.container.Container(cdir, sudo=False).destroy()
+        return False
+
+    # The job that claims this container clones the project into it
+    _util.symlink(
+        cdir / "af/config/aportsdir",
+        cdir / apkfoundry.MOUNTS["aportsdir"].lstrip("/"),
+        cdir,
+    )
+    (cdir / _DIGEST_FILE).write_text(digest)
+
+    os.rename(cdir, pooldir / cdir.name)
+    _LOGGER.info("Container %s is ready", cdir.name)
+    return True
+
+def _pool_args(args):
+    opts = argparse.ArgumentParser(
+        usage="af-pool [options ...] PROJECT APORTSDIR",
+        description="""Bootstrap containers ahead of time for PROJECT
+        so that CI jobs can claim them instead of starting from
+        scratch.""",
+    )
+    opts.add_argument(
+        "--arch",
+        help=f"""APK architecture name (default:
+        {apkfoundry.DEFAULT_ARCH})""",
+    )
+    opts.add_argument(
+        "--branch",
+        help="""git branch for APORTSDIR (default: detect). This is
+        useful when APORTSDIR is in a detached HEAD state.""",
+    )
+    opts.add_argument(
+        "--cache-apk",
+        help="external APK cache directory (default: none)",
+    )
+    opts.add_argument(
+        "--cache-src",
+        help="external source file cache directory (default: none)",
+    )
+    opts.add_argument(
+        "--count", type=int,
+        help="""number of ready containers to keep (default: site
+        configuration container.pool-size)""",
+    )
+    opts.add_argument(
+        "--setarch",
+        help="""setarch(8) architecture name (default: look in site
+        configuration, otherwise none)""",
+    )
+    opts.add_argument(
+        "project", metavar="PROJECT",
+        help="project name (e.g. CI_PROJECT_PATH_SLUG)",
+    )
+    opts.add_argument(
+        "aportsdir", metavar="APORTSDIR",
+        help="project git directory from which to take the configuration",
+    )
+    return opts.parse_args(args)
+
+def pool_fill(args):
+    opts = _pool_args(args)
+    if not opts.arch:
+        opts.arch = apkfoundry.DEFAULT_ARCH
+    if not opts.branch:
+        opts.branch = _util.get_branch(opts.aportsdir)
+    if opts.count is None:
+        opts.count = pool_size()
+
+    pooldir = pool_dir(opts.project, opts.branch, opts.arch)
+    pooldir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with _util.lock_file(pooldir / ".lock", blocking=False):
+            _purge_building(pooldir)
+            snapshot, digest = _snapshot_config(pooldir, opts.aportsdir)
+            _purge_stale(pooldir, digest)
+
+            ready = len(list(pooldir.glob("*.af")))
+            for _ in range(ready, opts.count):
+                if not _fill_one(pooldir, snapshot, digest, opts):
+                    return 1
+    except BlockingIOError:
+        _LOGGER.info("%s is already being refilled", pooldir.name)
+
+    return 0
@@ -6,7 +6,7 @@
 #define PROG "af-sudo"
 #define USAGE PROG " COMMAND [ARGS ...]"
 #define BUF_SIZE 4096
-#define NUM_FDS 3
+#define NUM_FDS 4
 
 #define _XOPEN_SOURCE 700
 #include <err.h>        /* err, errx      */
@@ -16,7 +16,7 @@
 #include <stdio.h>      /* snprintf       */
 #include <string.h>     /* memcpy, strcmp */
 #include <sys/socket.h>
-#include <unistd.h>     /* *_FILENO       */
+#include <unistd.h>     /* close, *_FILENO */
 
 #define FATAL_IF(what, why) \
 	errno = 0; \
@@ -85,9 +85,12 @@ static void send_cmd(int sock_fd, int my_fds[NUM_FDS], int argc, int start, char
 
 static int recv_retcode(int sock_fd) {
 	char buf[BUF_SIZE];
+	ssize_t len;
 	int *rc;
 
-	FATAL_IF(recv(sock_fd, buf, BUF_SIZE, 0) == -1, "recv_retcode recv");
+	FATAL_IF((len = recv(sock_fd, buf, BUF_SIZE, 0)) == -1, "recv_retcode recv");
+	if (len < (ssize_t) sizeof(int))
+		errx(3, "recv_retcode: connection closed");
 	rc = (int *) buf;
 	return *rc;
 }
@@ -95,7 +98,9 @@ static int recv_retcode(int sock_fd) {
 int main(int argc, char *argv[]) {
 	int start, sock_fd;
 	char *cmd;
-	int my_fds[NUM_FDS] = {STDIN_FILENO, STDOUT_FILENO, STDERR_FILENO};
+	/* The last FD is our private reply channel (see below) */
+	int my_fds[NUM_FDS] = {STDIN_FILENO, STDOUT_FILENO, STDERR_FILENO, -1};
+	int reply_fds[2];
 
 	if (argc == 0)
 		usage();
@@ -111,6 +116,17 @@ int main(int argc, char *argv[]) {
 
 	sock_fd = fd_from_env("AF_SUDO_FD");
 
+	/*
+	 * AF_SUDO_FD is shared by every process in the container, so each
+	 * request carries its own socket for the server to answer on.
+	 */
+	FATAL_IF(
+		socketpair(AF_UNIX, SOCK_SEQPACKET, 0, reply_fds) == -1,
+		"socketpair"
+	);
+	my_fds[3] = reply_fds[1];
+
 	send_cmd(sock_fd, my_fds, argc, start, argv);
-	return recv_retcode(sock_fd);
+	close(reply_fds[1]);
+	return recv_retcode(reply_fds[0]);
 }
@@ -0,0 +1,176 @@
+/*
+ * SPDX-License-Identifier: GPL-2.0-only
+ * Copyright (c) 2020 Max Rees
+ * See LICENSE for more information.
+ */
+#define PROG "af-sudod"
+#define USAGE PROG " FD"
+#define BUF_SIZE 4096
+#define NUM_FDS 4
+
+#define _GNU_SOURCE
+#include <err.h>        /* err, errx                   */
+#include <errno.h>      /* errno                       */
+#include <fcntl.h>      /* fcntl, FD_CLOEXEC, F_SETFD  */
+#include <signal.h>     /* signal, SIGCHLD, SIG_*      */
+#include <stdlib.h>     /* strtol                      */
+#include <string.h>     /* memcpy                      */
+#include <sys/socket.h>
+#include <sys/wait.h>   /* waitpid, W*                 */
+#include <unistd.h>     /* close, dup2, execv, fork... */
+
+/*
+ * Long-lived executor for privileged af-sudo commands. The broker
+ * outside the container has already validated each command; we just
+ * fork and exec it with the given standard streams and report the
+ * return code on the reply socket that came with the request.
+ *
+ * Each request is a single SOCK_SEQPACKET message consisting of the
+ * NUL-separated argv and NUM_FDS file descriptors: stdin, stdout,
+ * stderr, and the reply socket.
+ */
+
+static void usage(void) {
+	errx(1, "usage: %s", USAGE);
+}
+
+static void close_fds(int fds[NUM_FDS]) {
+	int i;
+
+	for (i = 0; i < NUM_FDS; i++) {
+		if (fds[i] != -1)
+			close(fds[i]);
+		fds[i] = -1;
+	}
+}
+
+static ssize_t recv_cmd(int sock_fd, char buf[BUF_SIZE], int fds[NUM_FDS]) {
+	ssize_t len;
+	int i, found;
+	struct iovec iov;
+	struct msghdr msg = {0};
+	struct cmsghdr *cmsg;
+	unsigned char cbuf[CMSG_SPACE(NUM_FDS * sizeof(int))];
+
+	for (i = 0; i < NUM_FDS; i++)
+		fds[i] = -1;
+
+	iov.iov_base = buf;
+	iov.iov_len = BUF_SIZE - 1;
+	msg.msg_iov = &iov;
+	msg.msg_iovlen = 1;
+	msg.msg_control = cbuf;
+	msg.msg_controllen = sizeof(cbuf);
+
+	do {
+		len = recvmsg(sock_fd, &msg, MSG_CMSG_CLOEXEC);
+	} while (len == -1 && errno == EINTR);
+	if (len == -1)
+		err(3, "recvmsg");
+	if (len == 0)
+		return 0;
+	buf[len] = '\0';
+
+	found = 0;
+	for (cmsg = CMSG_FIRSTHDR(&msg); cmsg; cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+		if (cmsg->cmsg_level != SOL_SOCKET || cmsg->cmsg_type != SCM_RIGHTS)
+			continue;
+		if (cmsg->cmsg_len != CMSG_LEN(NUM_FDS * sizeof(int)))
+			continue;
+		memcpy(fds, CMSG_DATA(cmsg), NUM_FDS * sizeof(int));
+		found = 1;
+	}
+
+	if (!found || (msg.msg_flags & (MSG_TRUNC | MSG_CTRUNC))) {
+		warnx("ignoring malformed request");
+		close_fds(fds);
+		return -1;
+	}
+
+	return len;
+}
+
+static void run_cmd(char buf[BUF_SIZE], ssize_t len, int fds[NUM_FDS]) {
+	char *argv[BUF_SIZE / 2 + 1];
+	int argc, i, status, rc;
+	pid_t pid;
+
+	argc = 0;
+	argv[argc++] = buf;
+	for (i = 0; i < len; i++) {
+		if (buf[i] == '\0')
+			argv[argc++] = buf + i + 1;
+	}
+	argv[argc] = 0;
+
+	/* The waiter reports the return code so the main loop never blocks */
+	if (fork() != 0)
+		return;
+
+	signal(SIGCHLD, SIG_DFL);
+	pid = fork();
+	if (pid == -1)
+		err(3, "fork");
+
+	if (pid == 0) {
+		for (i = 0; i < 3; i++) {
+			/*
+			 * The fds were received with MSG_CMSG_CLOEXEC, and
+			 * dup2 leaves the flag alone if they already match
+			 */
+			if (fds[i] == i) {
+				if (fcntl(i, F_SETFD, 0) == -1)
+					err(127, "fcntl");
+			} else if (dup2(fds[i], i) == -1) {
+				err(127, "dup2");
+			}
+		}
+		setsid();
+		execv(argv[0], argv);
+		err(127, "execv: %s", argv[0]);
+	}
+
+	while (waitpid(pid, &status, 0) == -1) {
+		if (errno != EINTR)
+			err(3, "waitpid");
+	}
+
+	if (WIFEXITED(status))
+		rc = WEXITSTATUS(status);
+	else if (WIFSIGNALED(status))
+		rc = 128 + WTERMSIG(status);
+	else
+		rc = 1;
+
+	send(fds[3], &rc, sizeof(rc), MSG_NOSIGNAL);
+	_exit(0);
+}
+
+int main(int argc, char *argv[]) {
+	int sock_fd;
+	int fds[NUM_FDS];
+	char buf[BUF_SIZE];
+	ssize_t len;
+
+	if (argc != 2)
+		usage();
+
+	errno = 0;
+	sock_fd = (int) strtol(argv[1], 0, 10);
+	if (errno != 0)
+		errx(1, "%s is not a valid FD", argv[1]);
+	if (fcntl(sock_fd, F_SETFD, FD_CLOEXEC) == -1)
+		err(1, "fcntl");
+
+	/* Waiters are reaped automatically */
+	signal(SIGCHLD, SIG_IGN);
+
+	while ((len = recv_cmd(sock_fd, buf, fds)) != 0) {
+		if (len < 0)
+			continue;
+		run_cmd(buf, len, fds);
+		close_fds(fds);
+	}
+
+	return 0;
+}
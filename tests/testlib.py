@@ -0,0 +1,19 @@
+# SPDX-License-Identifier: GPL-2.0-only
+# Copyright (c) 2020 Max Rees
+# See LICENSE for more information.
+# Helpers shared by the Python tests, which run with this directory as
+# the first entry of sys.path.
+import sys # exit
+
+def check(cond, msg):
+    if not cond:
+        print("FAIL:", msg)
+        sys.exit(1)
+
+class StubContainer:
+    """Stands in for a Container where only its directory and
+    architecture are used. Subclasses provide run() if needed."""
+
+    def __init__(self, cdir, arch="x86_64"):
+        self.cdir = cdir
+        self.arch = arch